@@ -0,0 +1,79 @@
+"""
+Queries and rows shared by the benchmarks.
+"""
+from mongoql_conv import LaxNone
+
+#: Query shapes for the compile benchmarks.
+QUERIES = {
+    'small': {'field1': 1, 'field2': {'$gt': 2}},
+    'deep': {'$and': [
+        {'$or': [{'field%s' % i: {'$gte': i, '$lt': i + 5}}, {'other%s' % i: 'value'}]}
+        for i in range(50)
+    ]},
+    'wide': {'field1': {'$in': list(range(10000))}, 'field2': {'$nin': ['value%s' % i for i in range(1000)]}},
+    'regex': {'field%s' % i: {'$regex': '^value%s' % i, '$options': 'i'} for i in range(20)},
+}
+
+#: A query for each operator, with the equivalent hand-written functions (strict and lax).
+OPERATORS = {
+    'gt': ({'number': {'$gt': 5}}, lambda item: item['number'] > 5, lambda item: item.get('number', LaxNone) > 5),
+    'gte': ({'number': {'$gte': 5}}, lambda item: item['number'] >= 5, lambda item: item.get('number', LaxNone) >= 5),
+    'lt': ({'number': {'$lt': 5}}, lambda item: item['number'] < 5, lambda item: item.get('number', LaxNone) < 5),
+    'lte': ({'number': {'$lte': 5}}, lambda item: item['number'] <= 5, lambda item: item.get('number', LaxNone) <= 5),
+    'eq': ({'number': 5}, lambda item: item['number'] == 5, lambda item: item.get('number', LaxNone) == 5),
+    'ne': ({'number': {'$ne': 5}}, lambda item: item['number'] != 5, lambda item: item.get('number', LaxNone) != 5),
+    'in': (
+        {'number': {'$in': [1, 3, 5, 7]}},
+        lambda item, values={1, 3, 5, 7}: item['number'] in values,
+        lambda item, values={1, 3, 5, 7}: 'number' in item and item['number'] in values,
+    ),
+    'nin': (
+        {'number': {'$nin': [1, 3, 5, 7]}},
+        lambda item, values={1, 3, 5, 7}: item['number'] not in values,
+        lambda item, values={1, 3, 5, 7}: 'number' not in item or item['number'] not in values,
+    ),
+    'mod': (
+        {'number': {'$mod': [3, 1]}},
+        lambda item: item['number'] % 3 == 1,
+        lambda item: item.get('number', LaxNone) % 3 == 1,
+    ),
+    'size': ({'items': {'$size': 2}}, lambda item: len(item['items']) == 2, lambda item: len(item.get('items', ())) == 2),
+    'all': (
+        {'items': {'$all': [1, 2]}},
+        lambda item, values={1, 2}: set(item['items']) >= values,
+        lambda item, values={1, 2}: set(item.get('items', ())) >= values,
+    ),
+    'exists': ({'number': {'$exists': True}}, lambda item: 'number' in item, lambda item: 'number' in item),
+    'regex': (
+        {'name': {'$regex': '^name1'}},
+        lambda item, search=__import__('re').compile('^name1').search: search(item['name']),
+        lambda item, search=__import__('re').compile('^name1').search: search(item.get('name', '')),
+    ),
+    'repeated': (
+        {'number': {'$gte': 1, '$lt': 9, '$ne': 5, '$nin': [3, 4]}},
+        lambda item, values={3, 4}: (
+            item['number'] >= 1 and item['number'] < 9 and item['number'] != 5 and item['number'] not in values
+        ),
+        lambda item, values={3, 4}: (
+            item.get('number', LaxNone) >= 1 and item.get('number', LaxNone) < 9 and
+            item.get('number', LaxNone) != 5 and ('number' not in item or item['number'] not in values)
+        ),
+    ),
+    'regex-literal': (
+        {'name': {'$regex': 'e1'}},
+        lambda item, search=__import__('re').compile('e1').search: search(item['name']),
+        lambda item, search=__import__('re').compile('e1').search: search(item.get('name', '')),
+    ),
+    'regex-ignorecase': (
+        {'name': {'$regex': 'E1', '$options': 'i'}},
+        lambda item, search=__import__('re').compile('E1', 2).search: search(item['name']),
+        lambda item, search=__import__('re').compile('E1', 2).search: search(item.get('name', '')),
+    ),
+    'regex-pattern': (
+        {'name': {'$regex': 'e1+$'}},
+        lambda item, search=__import__('re').compile('e1+$').search: search(item['name']),
+        lambda item, search=__import__('re').compile('e1+$').search: search(item.get('name', '')),
+    ),
+}
+
+ROWS = [{'number': i % 10, 'items': [i % 3, i % 5], 'name': 'name%s' % i} for i in range(1000)]
@@ -0,0 +1,32 @@
+"""
+Filters an asynchronous feed with ``afilter``, item by item (``batch_size=1``, the baseline) and in batches, with and
+without read-ahead. Requires Python 3.6.
+"""
+import asyncio
+
+import pytest
+from queries import ROWS
+
+from mongoql_conv.aio import afilter
+
+QUERY = {'number': {'$gte': 2}, 'name': {'$ne': 'name5'}}
+
+
+async def feed(rows):
+    for row in rows:
+        yield row
+
+
+async def collect(matches):
+    return [item async for item in matches]
+
+
+def run(**options):
+    return asyncio.run(collect(afilter(QUERY, feed(ROWS * 10), **options)))
+
+
+@pytest.mark.parametrize('queue_size', [0, 4], ids=['direct', 'queued'])
+@pytest.mark.parametrize('batch_size', [1, 100, 1000])
+def test_afilter(benchmark, batch_size, queue_size):
+    benchmark.group = 'afilter: queue_size=%s' % queue_size
+    assert benchmark(run, batch_size=batch_size, queue_size=queue_size) == run(batch_size=len(ROWS) * 10)
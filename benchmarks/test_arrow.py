@@ -0,0 +1,48 @@
+"""
+Reads the matching rows of a Parquet file (sorted by ``number``, in row groups of 10000 rows) by loading all the rows
+in dicts and filtering them with ``to_filter`` (the baseline), and with ``read_table``.
+"""
+import pytest
+
+from mongoql_conv import to_filter
+
+pyarrow = pytest.importorskip('pyarrow')
+parquet = pytest.importorskip('pyarrow.parquet')
+arrow = pytest.importorskip('mongoql_conv.arrow')
+
+SIZE = 200000
+
+QUERIES = {
+    'selective': {'number': {'$gte': 199000}, 'name': {'$regex': '^name1'}},
+    'half': {'number': {'$lt': 100000}, 'group': {'$in': [1, 2, 3]}},
+    'residual': {'number': {'$gte': 190000}, 'group': {'$mod': [3, 0]}},
+}
+
+
+@pytest.fixture(scope='module')
+def path(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('arrow').join('rows.parquet'))
+    parquet.write_table(pyarrow.table({
+        'number': list(range(SIZE)),
+        'group': [i % 10 for i in range(SIZE)],
+        'name': ['name%s' % i for i in range(SIZE)],
+        'payload': ['x' * 50] * SIZE,
+    }), path, row_group_size=10000)
+    return path
+
+
+def read_all(path, query):
+    return to_filter(query, lax=True)(parquet.read_table(path).to_pylist())
+
+
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_read_all(benchmark, path, shape):
+    benchmark.group = 'parquet: %s' % shape
+    benchmark(read_all, path, QUERIES[shape])
+
+
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_read_table(benchmark, path, shape):
+    benchmark.group = 'parquet: %s' % shape
+    table = benchmark(arrow.read_table, path, QUERIES[shape])
+    assert table.to_pylist() == read_all(path, QUERIES[shape])
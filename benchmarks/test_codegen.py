@@ -0,0 +1,23 @@
+import sys
+
+import pytest
+from queries import QUERIES
+
+from mongoql_conv import to_filter
+from mongoql_conv import to_func
+
+CODEGENS = ['string', pytest.param('ast', marks=pytest.mark.skipif(sys.version_info[0] < 3, reason="Python 3 only"))]
+
+
+@pytest.mark.parametrize('codegen', CODEGENS)
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_to_func_compile(benchmark, shape, codegen):
+    benchmark.group = 'to_func compile: %s' % shape
+    benchmark(to_func, QUERIES[shape], codegen=codegen)
+
+
+@pytest.mark.parametrize('codegen', CODEGENS)
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_to_filter_compile(benchmark, shape, codegen):
+    benchmark.group = 'to_filter compile: %s' % shape
+    benchmark(to_filter, QUERIES[shape], lax=True, codegen=codegen)
@@ -0,0 +1,36 @@
+import pytest
+from queries import QUERIES
+
+from mongoql_conv import DiskCache
+from mongoql_conv import to_func
+from mongoql_conv import to_string
+
+
+@pytest.mark.parametrize('lax', [False, True], ids=['strict', 'lax'])
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_to_string(benchmark, shape, lax):
+    benchmark.group = 'compile: %s' % shape
+    benchmark(to_string, QUERIES[shape], lax=lax)
+
+
+@pytest.mark.parametrize('use_arguments', [True, False], ids=['arguments', 'no-arguments'])
+@pytest.mark.parametrize('lax', [False, True], ids=['strict', 'lax'])
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_to_func(benchmark, shape, lax, use_arguments):
+    benchmark.group = 'compile: %s' % shape
+    benchmark(to_func, QUERIES[shape], use_arguments=use_arguments, lax=lax)
+
+
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_to_Q(benchmark, shape):
+    django = pytest.importorskip('mongoql_conv.django')
+    benchmark.group = 'compile: %s' % shape
+    benchmark(django.to_Q, QUERIES[shape])
+
+
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_to_func_disk_cache(benchmark, shape, tmpdir):
+    cache = DiskCache(str(tmpdir))
+    to_func(QUERIES[shape], cache=cache)
+    benchmark.group = 'compile: %s' % shape
+    benchmark(to_func, QUERIES[shape], cache=cache)
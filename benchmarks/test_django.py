@@ -0,0 +1,53 @@
+"""
+Builds the ``Q`` trees for wide queries with ``to_Q`` and records the size of the SQL made from them for ``MyModel``
+(under the test project's sqlite database).
+"""
+from functools import reduce
+from operator import and_
+from operator import or_
+
+import pytest
+
+django = pytest.importorskip('mongoql_conv.django')
+Q = pytest.importorskip('django.db.models').Q
+
+#: Wide queries, with hundreds of clauses or values.
+WIDE = {
+    'and': {'$and': [{'field1': {'$ne': i}} for i in range(500)]},
+    'or': {'$or': [{'field1': i, 'field2': str(i)} for i in range(500)]},
+    'in': {'field1': {'$in': list(range(10000))}, 'field2': {'$nin': [str(i) for i in range(1000)]}},
+}
+
+
+class PairwiseVisitor(django.DjangoVisitor):
+    """
+    Combines the ``Q`` objects two at a time (the baseline).
+    """
+    def visit_and(self, parts, field_name, context, operator=and_):
+        return reduce(operator, [self.visit_query(part, field_name) for part in parts]) if parts else Q()
+
+    def visit_or(self, parts, field_name, context):
+        return self.visit_and(parts, field_name, context, or_) if parts else Q(pk__in=[])
+
+    def render_and(self, parts, field_name, context):
+        return reduce(and_, parts) if parts else Q()
+
+
+def sql_size(tree):
+    from test_app.models import MyModel
+    return len(str(MyModel.objects.filter(tree).query))
+
+
+@pytest.mark.parametrize('shape', sorted(WIDE))
+def test_pairwise(benchmark, shape):
+    benchmark.group = 'to_Q: %s' % shape
+    tree = benchmark(PairwiseVisitor().visit, WIDE[shape])
+    benchmark.extra_info['sql_size'] = sql_size(tree)
+
+
+@pytest.mark.parametrize('in_threshold', [None, 500], ids=['unchunked', 'chunked'])
+@pytest.mark.parametrize('shape', sorted(WIDE))
+def test_to_Q(benchmark, shape, in_threshold):
+    benchmark.group = 'to_Q: %s' % shape
+    tree = benchmark(django.to_Q, WIDE[shape], in_threshold=in_threshold)
+    benchmark.extra_info['sql_size'] = sql_size(tree)
@@ -0,0 +1,55 @@
+import sys
+
+import pytest
+from queries import OPERATORS
+from queries import ROWS
+
+from mongoql_conv import to_filter
+from mongoql_conv import to_func
+
+CODEGENS = ['string', pytest.param('ast', marks=pytest.mark.skipif(sys.version_info[0] < 3, reason="Python 3 only"))]
+
+
+def run(func):
+    for row in ROWS:
+        func(row)
+
+
+@pytest.mark.parametrize('lax', [False, True], ids=['strict', 'lax'])
+@pytest.mark.parametrize('operator', sorted(OPERATORS))
+def test_baseline(benchmark, operator, lax):
+    query, strict_func, lax_func = OPERATORS[operator]
+    benchmark.group = 'evaluate: %s' % operator
+    benchmark(run, lax_func if lax else strict_func)
+
+
+@pytest.mark.parametrize('codegen', CODEGENS)
+@pytest.mark.parametrize('use_arguments', [True, False], ids=['arguments', 'no-arguments'])
+@pytest.mark.parametrize('lax', [False, True], ids=['strict', 'lax'])
+@pytest.mark.parametrize('operator', sorted(OPERATORS))
+def test_to_func(benchmark, operator, lax, use_arguments, codegen):
+    query, strict_func, lax_func = OPERATORS[operator]
+    func = to_func(query, use_arguments=use_arguments, lax=lax, codegen=codegen)
+    assert [bool(func(row)) for row in ROWS] == [bool((lax_func if lax else strict_func)(row)) for row in ROWS]
+    benchmark.group = 'evaluate: %s' % operator
+    benchmark(run, func)
+
+
+@pytest.mark.parametrize('codegen', CODEGENS)
+@pytest.mark.parametrize('lax', [False, True], ids=['strict', 'lax'])
+@pytest.mark.parametrize('operator', sorted(OPERATORS))
+def test_to_filter(benchmark, operator, lax, codegen):
+    query, _, _ = OPERATORS[operator]
+    benchmark.group = 'evaluate: %s' % operator
+    benchmark(to_filter(query, lax=lax, codegen=codegen), ROWS)
+
+
+@pytest.mark.parametrize('operator', sorted(set(OPERATORS) - {'size', 'all'}))
+def test_to_mask(benchmark, operator):
+    numpy = pytest.importorskip('numpy')
+    from mongoql_conv.numpy import to_mask
+
+    query, _, _ = OPERATORS[operator]
+    columns = {name: numpy.array([row[name] for row in ROWS]) for name in ('number', 'name')}
+    benchmark.group = 'evaluate: %s' % operator
+    benchmark(to_mask, query, columns)
@@ -0,0 +1,43 @@
+"""
+Finds the first 10 matches of a query over 100000 documents, sorted by a field (by sorting all the matches, the
+baseline, and with ``find``) and without sorting (by filtering all the documents, the baseline, and with ``find``).
+"""
+from mongoql_conv import find
+from mongoql_conv import to_filter
+from mongoql_conv.live import sort_key
+
+QUERY = {'group': {'$in': [1, 2, 3]}}
+
+DOCUMENTS = [{'_id': i, 'number': (i * 7919) % 100000, 'group': i % 10, 'name': 'name%s' % i} for i in range(100000)]
+
+PROJECTION = {'name': 1, 'number': 1}
+
+
+def full_sort():
+    matches = sorted(to_filter(QUERY)(DOCUMENTS), key=lambda document: sort_key(document['number']))
+    return [{'_id': document['_id'], 'name': document['name'], 'number': document['number']} for document in matches[:10]]
+
+
+def full_scan():
+    matches = to_filter(QUERY)(DOCUMENTS)
+    return [{'_id': document['_id'], 'name': document['name'], 'number': document['number']} for document in matches[:10]]
+
+
+def test_full_sort(benchmark):
+    benchmark.group = 'find: sort and limit'
+    benchmark(full_sort)
+
+
+def test_find_sorted(benchmark):
+    benchmark.group = 'find: sort and limit'
+    assert benchmark(lambda: list(find(QUERY, DOCUMENTS, PROJECTION, sort='number', limit=10))) == full_sort()
+
+
+def test_full_scan(benchmark):
+    benchmark.group = 'find: limit'
+    benchmark(full_scan)
+
+
+def test_find_streamed(benchmark):
+    benchmark.group = 'find: limit'
+    assert benchmark(lambda: list(find(QUERY, DOCUMENTS, PROJECTION, limit=10))) == full_scan()
@@ -0,0 +1,53 @@
+"""
+Applies 100 updates to 10000 documents and keeps the matches of a query up to date, by filtering all the documents
+after each update (the baseline) and with ``LiveQuery`` (built before the timing, with and without the names of the
+changed fields, and sorted by a field).
+"""
+import pytest
+
+from mongoql_conv import LiveQuery
+from mongoql_conv import to_filter
+
+QUERY = {
+    'number': {'$gte': 5000}, 'group': {'$in': [1, 2, 3]},
+    '$or': [{'code': {'$regex': '^[a-f0-9]{2}-x'}}, {'score': {'$mod': [3, 0]}}],
+}
+
+DOCUMENTS = [
+    {'_id': i, 'number': i, 'group': i % 10, 'name': 'name%s' % i, 'code': '%02x-%s' % (i % 256, 'xy'[i % 2]), 'score': i}
+    for i in range(10000)
+]
+
+UPDATES = [
+    (dict(DOCUMENTS[5000 + i * 47], number=(i * 7919) % 10000), ['number']) if i % 2 else
+    (dict(DOCUMENTS[5000 + i * 47], name='renamed%s' % i), ['name'])
+    for i in range(100)
+]
+
+
+def rescan():
+    documents = list(DOCUMENTS)
+    func = to_filter(QUERY)
+    for document, _ in UPDATES:
+        documents[document['_id']] = document
+        matches = func(documents)
+    return len(matches)
+
+
+def apply(query, use_changed):
+    for document, changed in UPDATES:
+        query.update(document, changed if use_changed else None)
+    return query.count
+
+
+def test_rescan(benchmark):
+    benchmark.group = 'live: updates'
+    benchmark(rescan)
+
+
+@pytest.mark.parametrize('use_changed', [False, True], ids=['documents', 'changed-fields'])
+@pytest.mark.parametrize('sort', [None, 'number'], ids=['unsorted', 'sorted'])
+def test_live(benchmark, use_changed, sort):
+    benchmark.group = 'live: updates'
+    count = benchmark.pedantic(apply, setup=lambda: ((LiveQuery(QUERY, DOCUMENTS, sort=sort), use_changed), {}), rounds=20)
+    assert count == rescan()
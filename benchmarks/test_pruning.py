@@ -0,0 +1,46 @@
+"""
+Filters 200 chunks of documents (sorted by ``number``) by matching every chunk (the baseline), and by skipping the
+chunks that ``can_match`` rules out. The number of scanned chunks is stored in ``extra_info``.
+"""
+import pytest
+from queries import ROWS
+
+from mongoql_conv import can_match
+from mongoql_conv import collect_stats
+from mongoql_conv import to_filter
+
+CHUNKS = [
+    [dict(row, number=chunk * 1000 + position) for position, row in enumerate(ROWS)]
+    for chunk in range(200)
+]
+STATS = [collect_stats(chunk) for chunk in CHUNKS]
+
+QUERIES = {
+    'range': {'number': {'$gte': 150000, '$lt': 152500}},
+    'in': {'number': {'$in': [1, 50000, 199999]}, 'name': {'$ne': 'name5'}},
+    'or': {'$or': [{'number': {'$lt': 1000}}, {'name': 'missing'}]},
+}
+
+
+def scan(query):
+    func = to_filter(query, lax=True)
+    return [item for chunk in CHUNKS for item in func(chunk)]
+
+
+def pruned(query):
+    func = to_filter(query, lax=True)
+    return [item for chunk, stats in zip(CHUNKS, STATS) if can_match(query, stats) is not False for item in func(chunk)]
+
+
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_scan(benchmark, shape):
+    benchmark.group = 'pruning: %s' % shape
+    benchmark.extra_info['chunks'] = len(CHUNKS)
+    benchmark(scan, QUERIES[shape])
+
+
+@pytest.mark.parametrize('shape', sorted(QUERIES))
+def test_can_match(benchmark, shape):
+    benchmark.group = 'pruning: %s' % shape
+    benchmark.extra_info['chunks'] = sum(can_match(QUERIES[shape], stats) is not False for stats in STATS)
+    assert benchmark(pruned, QUERIES[shape]) == scan(QUERIES[shape])
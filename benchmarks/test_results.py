@@ -0,0 +1,36 @@
+"""
+Runs a session of narrowing dashboard queries over 100000 documents, each one with a full scan (the baseline) and with
+a fresh ``ResultCache`` (so the later queries filter the results of the earlier ones).
+"""
+from mongoql_conv import ResultCache
+from mongoql_conv import to_filter
+
+DOCUMENTS = [{'number': i, 'group': i % 10, 'name': 'name%s' % i} for i in range(100000)]
+
+SESSION = [
+    {'number': {'$gt': 50000}},
+    {'number': {'$gt': 80000}},
+    {'number': {'$gt': 80000}, 'group': {'$in': [1, 2, 3]}},
+    {'number': {'$gt': 90000}, 'group': {'$in': [1, 2]}},
+    {'number': {'$gt': 90000, '$lt': 95000}, 'group': 1},
+    {'number': {'$gt': 90000}, 'group': {'$in': [1, 2]}},
+]
+
+
+def scan():
+    return [to_filter(query, lax=True)(DOCUMENTS) for query in SESSION]
+
+
+def cached():
+    cache = ResultCache(DOCUMENTS, lax=True)
+    return [cache.find(query) for query in SESSION]
+
+
+def test_scan(benchmark):
+    benchmark.group = 'results: session'
+    benchmark(scan)
+
+
+def test_result_cache(benchmark):
+    benchmark.group = 'results: session'
+    assert benchmark(cached) == scan()
@@ -0,0 +1,65 @@
+"""
+Visits large queries with ``ExprVisitor`` (the traversal alone, without compiling anything), validated and trusted.
+The number of clauses is stored in ``extra_info``, for the throughput.
+"""
+import pytest
+
+from mongoql_conv import ExprVisitor
+from mongoql_conv import InvalidQuery
+
+#: Large queries, with thousands of clauses.
+LARGE = {
+    'flat': {'field%s' % i: {'$gte': i, '$lt': i + 10, '$ne': 5} for i in range(1000)},
+    'nested': {'$and': [
+        {'$or': [{'field%s' % i: {'$gt': i}}, {'other%s' % i: 'value', 'sub.field%s' % i: {'$in': [1, 2]}}]}
+        for i in range(1000)
+    ]},
+    'regex': {'field%s' % i: {'$regex': '^value%s.*' % i, '$options': 'i'} for i in range(1000)},
+}
+
+
+def count_clauses(query):
+    total = 0
+    for name, value in query.items():
+        if name in ('$and', '$or'):
+            total += sum(count_clauses(part) for part in value)
+        elif isinstance(value, dict) and not name.startswith('$'):
+            total += count_clauses(value)
+        elif name != '$options':
+            total += 1
+    return total
+
+
+class CopyingVisitor(ExprVisitor):
+    """
+    Copies every query and looks up the handlers by name (the baseline).
+    """
+    def handle_query(self, query, field_name, context=None):
+        query = query.copy()
+        for name, value in query.items():
+            if name.startswith('$'):
+                handler = 'visit_' + name[1:]
+                if hasattr(self, handler):
+                    yield getattr(self, handler)(value, field_name, query)
+                else:
+                    raise InvalidQuery("%s doesn't support operator %r" % (type(self).__name__, name))
+            elif isinstance(value, dict):
+                yield self.visit_query(value, name, query)
+            else:
+                yield self.visit_eq(value, name, query)
+
+
+@pytest.mark.parametrize('shape', sorted(LARGE))
+def test_copying(benchmark, shape):
+    benchmark.group = 'visit: %s' % shape
+    benchmark.extra_info['clauses'] = count_clauses(LARGE[shape])
+    benchmark(CopyingVisitor(None, 'row').visit, LARGE[shape])
+
+
+@pytest.mark.parametrize('trusted', [False, True], ids=['validated', 'trusted'])
+@pytest.mark.parametrize('shape', sorted(LARGE))
+def test_visit(benchmark, shape, trusted):
+    benchmark.group = 'visit: %s' % shape
+    benchmark.extra_info['clauses'] = count_clauses(LARGE[shape])
+    result = benchmark(ExprVisitor(None, 'row', trusted=trusted).visit, LARGE[shape])
+    assert result == CopyingVisitor(None, 'row').visit(LARGE[shape])
@@ -5,6 +5,18 @@ if sys.version_info[0] == 2:  # shitty workaround for doctests
     from mongoql_conv import InvalidQuery
     InvalidQuery.__name__ = 'mongoql_conv.' + InvalidQuery.__name__
 
+collect_ignore = []  # the docs for the optional dependencies only run if these are available
+try:
+    import numpy  # noqa
+except ImportError:
+    collect_ignore.append('docs/numpy.rst')
+try:
+    import pyarrow  # noqa
+except ImportError:
+    collect_ignore.append('docs/arrow.rst')
+if sys.version_info < (3, 7):
+    collect_ignore.append('docs/aio.rst')
+
 try:
     from django import setup
 except ImportError:
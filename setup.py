@@ -64,6 +64,12 @@ setup(
     extras_require={
         'django': [
             'Django',
-        ]
+        ],
+        'numpy': [
+            'numpy',
+        ],
+        'arrow': [
+            'pyarrow',
+        ],
     }
 )
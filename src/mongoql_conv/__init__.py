@@ -2,25 +2,56 @@
 Converts a dict containing a mongo query to a lambda. Doesn't support all the mongo
 query $keywords, probably differs the result in subtle ways.
 
-It only supports querying flat structures: dicts with no lists or other dicts in
-them (aka subdocuments).
+Subdocuments can be queried with dotted field names (eg: ``"a.b.c"``). Lists are
+not traversed (``"a.0"`` looks up the ``"0"`` key).
 """
 from __future__ import absolute_import
 from __future__ import print_function
 
+import hashlib
 import linecache
+import marshal
+import multiprocessing
+import os
 import re
 import sys
+import tempfile
+import time
 import weakref
 import zlib
 from abc import ABCMeta
 from abc import abstractmethod
+from collections import OrderedDict
+from collections import namedtuple
+from functools import partial
+from itertools import islice
+from keyword import iskeyword
+from threading import RLock
+from timeit import default_timer
+from types import FunctionType
 from warnings import warn
 
+from six import exec_
 from six import reraise
+from six import string_types
 from six import with_metaclass
 
-__all__ = "InvalidQuery", "to_string", "to_func"
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:  # Python 2
+    from imp import get_magic
+    MAGIC_NUMBER = get_magic()
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+__all__ = (
+    "InvalidQuery", "to_string", "to_func", "to_filter", "QueryCache", "fingerprint", "CompiledQuery", "parallel_filter",
+    "CostModel", "normalize", "Collection", "QueryMatcher", "lookup", "Profile", "DiskCache", "can_match", "collect_stats",
+    "implies", "ResultCache", "LiveQuery", "find",
+)
 __version__ = "0.4.1"
 NoneType = type(None)
 
@@ -31,27 +62,43 @@ class InvalidQuery(Exception):
 
 def validated_method(validator_name, func):
     def validated_method_wrapper(self, value, *args, **kwargs):
-        if hasattr(self, validator_name):
-            value = getattr(self, validator_name)(value, *args, **kwargs)
-        else:
-            warn("Missing validator %s in %s" % (validator_name, type(self).__name__))
+        if not self.trusted:
+            validator = getattr(self, validator_name, None)
+            if validator is None:
+                warn("Missing validator %s in %s" % (validator_name, type(self).__name__))
+            else:
+                value = validator(value, *args, **kwargs)
         return func(self, value, *args, **kwargs)
+    validated_method_wrapper.__wrapped__ = func
     return validated_method_wrapper
 
 
+def dispatch_table(cls):
+    """
+    Maps each operator (eg: ``"$gt"``) to its ``visit_`` method and to the same method without the validation.
+    """
+    table = {}
+    for name in dir(cls):
+        method = getattr(cls, name)
+        if name.startswith('visit_') and callable(method):
+            table['$' + name[6:]] = method, getattr(method, '__wrapped__', method)
+    return table
+
+
 def validator_metaclass(base=type):
-    return type(
-        base.__name__ + "WithValidatorMeta",
-        (base, ),
-        {'__new__': lambda mcls, name, bases, namespace: base.__new__(mcls, name, bases, {
+    def __new__(mcls, name, bases, namespace):
+        cls = base.__new__(mcls, name, bases, {
             name: (
                 validated_method('validate_'+name[6:], func)
                 if callable(func) and name.startswith('visit_')
                 else func
             )
             for name, func in namespace.items()
-        })}
-    )
+        })
+        cls.dispatch = dispatch_table(cls)
+        return cls
+
+    return type(base.__name__ + "WithValidatorMeta", (base, ), {'__new__': __new__})
 
 
 def require(*types):
@@ -79,6 +126,76 @@ Stripped = object()
 Missing = object()
 
 
+class RegexPool(object):
+    """
+    A bounded pool of compiled regular expressions, shared by all the compiled queries (and by the validation, so a
+    regular expression is compiled only once). The least recently used pattern is dropped when there are more than
+    `maxsize` patterns.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.patterns = OrderedDict()
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def compile(self, regex, flags=0):
+        key = type(regex), regex, flags
+        with self.lock:
+            pattern = self.patterns.pop(key, None)
+            if pattern is None:
+                pattern = re.compile(regex, flags)
+            self.patterns[key] = pattern
+            while len(self.patterns) > self.maxsize:
+                self.patterns.popitem(last=False)
+            return pattern
+
+    def clear(self):
+        with self.lock:
+            self.patterns.clear()
+
+
+REGEX_POOL = RegexPool()
+compile_regex = REGEX_POOL.compile
+
+LITERAL_REGEX = re.compile(r'(\^?)((?:[^.^$*+?{}\[\]\\|()]|\\[^0-9A-Za-z\s])*)\Z')
+
+
+def literal_regex(regex, flags):
+    """
+    Gives back ``(literal, anchored, ignorecase)`` if the regular expression only looks for a literal string (at the
+    start if `anchored`), so that it can be replaced by ``in`` or ``str.startswith``. With `ignorecase` the literal is
+    lowercased and must be compared to the lowercased value. Otherwise gives back ``None``.
+    """
+    match = sys.version_info[0] > 2 and not flags & re.VERBOSE and LITERAL_REGEX.match(regex)
+    if not match:
+        return
+    anchored = bool(match.group(1))
+    if anchored and flags & re.MULTILINE:
+        return
+    literal = re.sub(r'\\(.)', r'\1', match.group(2))
+    ignorecase = bool(flags & re.IGNORECASE)
+    if ignorecase:
+        # only ASCII without the letters that re.IGNORECASE matches to characters that don't lowercase to them
+        literal = literal.lower()
+        if any(ord(char) > 127 or char in 'is' for char in literal):
+            return
+    return literal, anchored, ignorecase
+
+
+def render_literal(value, literal, anchored, ignorecase):
+    # like re.search these raise TypeError if the value isn't a string ('' + value does that for the "in" check)
+    if ignorecase:
+        value = 'str.lower(%s)' % value
+    if anchored:
+        return 'str.startswith(%s, %r)' % (value, literal)
+    elif ignorecase:
+        return '%r in %s' % (literal, value)
+    else:
+        return "%r in '' + %s" % (literal, value)
+
+
 class BaseVisitor(with_metaclass(validator_metaclass(base=ABCMeta))):
     validate_gt = validate_gte = validate_lt = validate_lte = validate_ne = validate_eq = staticmethod(require_value)
     validate_query = staticmethod(require(dict))
@@ -120,7 +237,7 @@ class BaseVisitor(with_metaclass(validator_metaclass(base=ABCMeta))):
                     )
                 raw_options |= getattr(re, opt.upper())
         try:
-            re.compile(regex, raw_options)
+            compile_regex(regex, raw_options)
         except re.error as exc:
             reraise(InvalidQuery, InvalidQuery("Invalid regular expression %r: %s" % (value, exc)), sys.exc_info()[2])
         context['$regex'] = Stripped
@@ -137,9 +254,19 @@ class BaseVisitor(with_metaclass(validator_metaclass(base=ABCMeta))):
     def render_and(self, parts):
         pass  # pragma: no cover
 
+    cost_model = None
+    #: Skip the validation (for queries that are known to be valid).
+    trusted = False
+
     def visit(self, query):
         return self.visit_query(query)
 
+    def ordered(self, parts, field_name, disjunction=False):
+        if self.cost_model is None:
+            return parts
+        else:
+            return self.cost_model.sort_queries(parts, field_name, disjunction)
+
     def visit_query(self, query, field_name=None, context=None):
         return self.render_and([
             part
@@ -148,44 +275,252 @@ class BaseVisitor(with_metaclass(validator_metaclass(base=ABCMeta))):
         ], field_name, context)
 
     def handle_query(self, query, field_name, context=None):
-        query = query.copy()
-        for name, value in query.items():
+        trusted = self.trusted
+        if not trusted and ('$regex' in query or '$options' in query):
+            query = query.copy()  # validate_regex strips the regex from the context
+        regex = None
+        items = query.items()
+        if self.cost_model is not None:
+            items = self.cost_model.sort_items(items, field_name)
+        for name, value in items:
             if name.startswith('$'):
-                opname = name[1:]
-                handler = 'visit_' + opname
-                if hasattr(self, handler):
-                    handler = getattr(self, handler)
-                    yield handler(value, field_name, query)
-                else:
+                handlers = self.dispatch.get(name)
+                if handlers is None:
                     raise InvalidQuery("%s doesn't support operator %r" % (type(self).__name__, name))
+                handler = handlers[trusted]
+                if name in ('$and', '$or'):
+                    yield handler(self, value, field_name, query)
+                    continue
+                elif name in ('$regex', '$options'):
+                    if trusted:
+                        value = Stripped if regex else self.trusted_regex(query)
+                        regex = True
+                    name = '$regex'
+                yield self.render_clause(handler(self, value, field_name, query), field_name, name)
             elif isinstance(value, dict):
                 yield self.visit_query(value, name, query)
             else:
-                yield self.visit_eq(value, name, query)
+                yield self.render_clause(self.visit_eq(value, name, query), name, '$eq')
+
+    def trusted_regex(self, query):
+        """
+        Gives back what :meth:`validate_regex` gives for a query that is known to be valid.
+        """
+        flags = 0
+        for option in query.get('$options', ''):
+            flags |= getattr(re, option.upper())
+        return query['$regex'], flags
+
+    def render_clause(self, part, field_name, operator):
+        """
+        Called with the result of each clause (the operators other than ``$and``/``$or``), gives back what goes in the
+        result instead.
+        """
+        return part
+
+
+def split_path(field_name):
+    """
+    Splits a dotted field name (eg: ``"a.b.c"``) in a tuple of keys.
+    """
+    if isinstance(field_name, string_types):
+        return tuple(field_name.split('.'))
+    else:
+        return field_name,
+
+
+def lookup(document, field_name, default=Missing):
+    """
+    Looks up a (dotted) field in `document`, treating missing levels (and levels that aren't mappings) as missing
+    fields. Gives back `default` for missing fields.
+    """
+    for key in split_path(field_name):
+        get = getattr(document, 'get', None)
+        if get is None:
+            return default
+        document = get(key, Missing)
+        if document is Missing:
+            return default
+    return document
+
+
+class MappingSchema(object):
+    """
+    The rows are mappings: ``item['field']`` (or ``item.get('field', LaxNone)`` in lax mode).
+    """
+    def key(self):
+        return 'mapping'
+
+    def field(self, object_name, name, lax=False, default='LaxNone'):
+        if lax:
+            return "%s.get(%r, %s)" % (object_name, name, default)
+        else:
+            return "%s[%r]" % (object_name, name)
+
+    def container(self, object_name, name, lax=False):
+        if lax:
+            return "subdocument(%s.get(%r))" % (object_name, name)
+        else:
+            return "%s[%r]" % (object_name, name)
+
+    def exists(self, object_name, name, negate=False):
+        return "%r %sin %s" % (name, 'not ' if negate else '', object_name)
+
+
+class IndexSchema(MappingSchema):
+    """
+    The rows are sequences (tuples from a DB-API cursor, lists from a CSV reader and so on) with the given `columns`:
+    ``item[3]``. Rows that are too short are missing the last fields and, in lax mode, so are the rows for fields that
+    aren't in `columns` at all (in strict mode these fields are an :class:`InvalidQuery`).
+    """
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        self.positions = dict((name, position) for position, name in reversed(list(enumerate(self.columns))))
+
+    def key(self):
+        return 'index', self.columns
+
+    def field(self, object_name, name, lax=False, default='LaxNone'):
+        position = self.positions.get(name)
+        if position is not None:
+            if lax:
+                return "(%s[%s] if len(%s) > %s else %s)" % (object_name, position, object_name, position, default)
+            else:
+                return "%s[%s]" % (object_name, position)
+        elif lax:
+            return default
+        else:
+            raise InvalidQuery("Invalid field %r. Must be one of: %s." % (name, ', '.join(self.columns)))
+
+    def container(self, object_name, name, lax=False):
+        if lax:
+            return "subdocument(%s)" % self.field(object_name, name, lax, 'None')
+        else:
+            return self.field(object_name, name)
+
+    def exists(self, object_name, name, negate=False):
+        position = self.positions.get(name)
+        if position is None:
+            return 'True' if negate else 'False'
+        else:
+            return "len(%s) %s %s" % (object_name, '<=' if negate else '>', position)
+
+
+class AttributeSchema(MappingSchema):
+    """
+    The rows are objects (namedtuples, dataclasses, classes with ``__slots__`` and so on): ``item.field`` (or
+    ``getattr(item, 'field', LaxNone)`` in lax mode).
+    """
+    def key(self):
+        return 'attribute'
+
+    def field(self, object_name, name, lax=False, default='LaxNone'):
+        if lax:
+            return "getattr(%s, %r, %s)" % (object_name, name, default)
+        elif is_identifier(name):
+            return "%s.%s" % (object_name, name)
+        else:
+            return "getattr(%s, %r)" % (object_name, name)
+
+    def container(self, object_name, name, lax=False):
+        if lax:
+            return "subdocument(getattr(%s, %r, None))" % (object_name, name)
+        else:
+            return self.field(object_name, name)
+
+    def exists(self, object_name, name, negate=False):
+        return "%shasattr(%s, %r)" % ('not ' if negate else '', object_name, name)
+
+
+def is_identifier(name):
+    return bool(re.match(r'[A-Za-z_][A-Za-z0-9_]*\Z', name)) and not iskeyword(name)
+
+
+def make_schema(schema):
+    """
+    Gives back the schema for the `schema` argument of :func:`to_func`: ``None`` (mappings), ``"attribute"``, a list
+    of column names, a namedtuple class (the same as its list of fields) or any other class (the same as
+    ``"attribute"``).
+    """
+    if schema is None:
+        return MAPPING
+    elif isinstance(schema, MappingSchema):
+        return schema
+    elif schema == 'attribute':
+        return AttributeSchema()
+    elif isinstance(schema, type):
+        if hasattr(schema, '_fields'):
+            return IndexSchema(schema._fields)
+        else:
+            return AttributeSchema()
+    elif isinstance(schema, (list, tuple)) and all(isinstance(name, string_types) for name in schema):
+        return IndexSchema(schema)
+    else:
+        raise ValueError("Invalid schema %r. Must be None, 'attribute', a list of columns or a class." % (schema,))
+
+
+MAPPING = MappingSchema()
+
+
+def render_path(object_name, keys, hoisted=None, lax=False, schema=None):
+    """
+    Renders the expression for the subdocument at `keys` (a tuple). The longest prefix found in `hoisted` (a mapping of
+    key tuples to local names) is used as a starting point. In `lax` mode missing levels (and levels that aren't
+    mappings) give ``LaxNone``. The first level is looked up as the `schema` says, the subdocuments are always mappings.
+    """
+    start = 0
+    if hoisted:
+        for position in range(len(keys), 0, -1):
+            if keys[:position] in hoisted:
+                object_name, start = hoisted[keys[:position]], position
+                break
+    for position in range(start, len(keys)):
+        object_name = (schema if position == 0 and schema else MAPPING).container(object_name, keys[position], lax)
+    return object_name
+
+
+def resolve_field(object_name, field_name, hoisted=None, lax=False, schema=None):
+    """
+    Gives back the schema to look up the last key of `field_name` with, the expression for its container and the key.
+    """
+    keys = split_path(field_name)
+    container = render_path(object_name, keys[:-1], hoisted, lax, schema)
+    return (schema or MAPPING) if len(keys) == 1 else MAPPING, container, keys[-1]
 
 
 class ExprVisitor(BaseVisitor):
-    def __init__(self, closure, object_name):
+    def __init__(self, closure, object_name, cost_model=None, hoisted=None, schema=None, profile=None, trusted=False):
         self.closure = closure
         self.object_name = object_name
+        self.cost_model = cost_model
+        self.hoisted = hoisted
+        self.schema = schema
+        self.profile = profile
+        self.trusted = trusted
+        # $exists never raises, so it looks into the hoisted subdocuments like the lax functions do
+        self.lax_hoisted = hoisted and dict((keys, 'subdocument(%s)' % var_name) for keys, var_name in hoisted.items())
+
+    def field(self, field_name):
+        schema, container, key = resolve_field(self.object_name, field_name, self.hoisted, schema=self.schema)
+        return schema.field(container, key)
 
     def visit_gt(self, value, field_name, context):
-        return "%s[%r] > %r" % (self.object_name, field_name, value)
+        return "%s > %r" % (self.field(field_name), value)
 
     def visit_gte(self, value, field_name, context):
-        return "%s[%r] >= %r" % (self.object_name, field_name, value)
+        return "%s >= %r" % (self.field(field_name), value)
 
     def visit_lt(self, value, field_name, context):
-        return "%s[%r] < %r" % (self.object_name, field_name, value)
+        return "%s < %r" % (self.field(field_name), value)
 
     def visit_lte(self, value, field_name, context):
-        return "%s[%r] <= %r" % (self.object_name, field_name, value)
+        return "%s <= %r" % (self.field(field_name), value)
 
     def visit_ne(self, value, field_name, context):
-        return "%s[%r] != %r" % (self.object_name, field_name, value)
+        return "%s != %r" % (self.field(field_name), value)
 
     def visit_eq(self, value, field_name, context):
-        return "%s[%r] == %r" % (self.object_name, field_name, value)
+        return "%s == %r" % (self.field(field_name), value)
 
     def visit_in(self, value, field_name, context, operator='in'):
         if self.closure is None:
@@ -193,16 +528,19 @@ class ExprVisitor(BaseVisitor):
         else:
             var_name = "var%s" % len(self.closure)
             self.closure[var_name] = "{%s}" % ", ".join(repr(i) for i in value)
-        return "%s[%r] %s %s" % (self.object_name, field_name, operator, var_name)
+        return "%s %s %s" % (self.field(field_name), operator, var_name)
 
     def visit_nin(self, value, field_name, context):
         return self.visit_in(value, field_name, context, 'not in')
 
-    def visit_and(self, parts, field_name, context, operator=' and '):
-        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context, operator)
+    def visit_and(self, parts, field_name, context, operator=' and ', disjunction=False):
+        return self.render_and([
+            self.visit_query(part, field_name)
+            for part in self.ordered(parts, field_name, disjunction)
+        ], field_name, context, operator)
 
     def visit_or(self, parts, field_name, context):
-        return self.visit_and(parts, field_name, context, ' or ')
+        return self.visit_and(parts, field_name, context, ' or ', True) if parts else 'False'
 
     def render_and(self, parts, field_name, context, operator=' and '):
         multiple = len(parts) > 1
@@ -213,34 +551,41 @@ class ExprVisitor(BaseVisitor):
             return Skip
         else:
             regex, options = value
+            literal = literal_regex(regex, options)
 
-            if self.closure is None:
-                return "re.search(%r, %s[%r], %d)" % (regex, self.object_name, field_name, options)
+            if literal is not None:
+                return render_literal(self.field(field_name), *literal)
+            elif self.closure is None:
+                return "re.search(%r, %s, %d)" % (regex, self.field(field_name), options)
             else:
                 var_name = "var%s" % len(self.closure)
-                self.closure[var_name] = "re.compile(%r, %d)" % (regex, options)
-                return '%s.search(%s[%r])' % (var_name, self.object_name, field_name)
+                self.closure[var_name] = "compile_regex(%r, %d)" % (regex, options)
+                return '%s.search(%s)' % (var_name, self.field(field_name))
     visit_options = visit_regex
 
     def visit_size(self, value, field_name, context):
-        return "len(%s[%r]) == %r" % (self.object_name, field_name, value)
+        return "len(%s) == %r" % (self.field(field_name), value)
 
     def visit_all(self, value, field_name, context):
         if self.closure is None:
-            return 'set(%s[%r]) >= {%s}' % (self.object_name, field_name, ', '.join(repr(i) for i in value))
+            return 'set(%s) >= {%s}' % (self.field(field_name), ', '.join(repr(i) for i in value))
         else:
             var_name = "var%s" % len(self.closure)
             self.closure[var_name] = "{%s}" % ', '.join(repr(i) for i in value)
-            return 'set(%s[%r]) >= %s' % (self.object_name, field_name, var_name)
+            return 'set(%s) >= %s' % (self.field(field_name), var_name)
 
     def visit_mod(self, value, field_name, context):
         divisor, remainder = value
-        return '%s[%r] %% %s == %s' % (self.object_name, field_name, divisor, remainder)
+        return '%s %% %s == %s' % (self.field(field_name), divisor, remainder)
 
     def visit_exists(self, value, field_name, context):
-        return '%r %sin %s' % (
-            field_name, '' if value else 'not ', self.object_name,
-        )
+        schema, container, key = resolve_field(self.object_name, field_name, self.lax_hoisted, True, self.schema)
+        return schema.exists(container, key, not value)
+
+    def render_clause(self, part, field_name, operator):
+        if self.profile is None or part is Skip:
+            return part
+        return 'probe(%s, lambda: %s)' % (self.profile.add(field_name, operator, part), part)
 
 
 class LaxNone(object):
@@ -250,33 +595,84 @@ class LaxNone(object):
     __iter__ = staticmethod(lambda: iter(()))
     __mod__ = staticmethod(lambda _: LaxNone)
     __hash__ = None
+    get = staticmethod(lambda key, default=None: default)
 
 
 LaxNone = LaxNone()
 
 
+def subdocument(value):
+    """
+    Gives back `value` if it's a mapping, otherwise ``LaxNone`` (so the lax lookups treat scalars, strings and lists
+    on the way to a dotted field as missing levels, like :func:`lookup` does).
+    """
+    return value if type(value) is dict or isinstance(value, Mapping) else LaxNone
+
+
+class Unresolved(object):
+    """
+    Stands for a subdocument that couldn't be looked up (in strict mode). The original error is raised only if a field
+    is looked up in it.
+    """
+    def __init__(self, error):
+        self.error = error
+
+    def __getitem__(self, key):
+        raise self.error
+
+    def __contains__(self, key):
+        return False
+
+    def __bool__(self):
+        return False
+    __nonzero__ = __bool__
+
+
 class LaxExprVisitor(BaseVisitor):
-    def __init__(self, closure, object_name):
+    def __init__(self, closure, object_name, cost_model=None, hoisted=None, schema=None, profile=None, trusted=False,
+                 loaded=None):
         self.closure = closure
         self.object_name = object_name
+        self.cost_model = cost_model
+        self.hoisted = hoisted
+        self.schema = schema
+        self.profile = profile
+        self.trusted = trusted
+        self.loaded = loaded or {}
+
+    def field(self, field_name, default='LaxNone'):
+        var_name = self.loaded.get(field_name)
+        if var_name is not None:
+            return var_name if default == 'LaxNone' else '(%s if %s is not LaxNone else %s)' % (
+                var_name, var_name, default
+            )
+        schema, container, key = resolve_field(self.object_name, field_name, self.hoisted, True, self.schema)
+        return schema.field(container, key, True, default)
+
+    def exists(self, field_name, negate=False):
+        var_name = self.loaded.get(field_name)
+        if var_name is not None:
+            return '%s is %sLaxNone' % (var_name, '' if negate else 'not ')
+        schema, container, key = resolve_field(self.object_name, field_name, self.hoisted, True, self.schema)
+        return schema.exists(container, key, negate)
 
     def visit_gt(self, value, field_name, context):
-        return "%s.get(%r, LaxNone) > %r" % (self.object_name, field_name, value)
+        return "%s > %r" % (self.field(field_name), value)
 
     def visit_gte(self, value, field_name, context):
-        return "%s.get(%r, LaxNone) >= %r" % (self.object_name, field_name, value)
+        return "%s >= %r" % (self.field(field_name), value)
 
     def visit_lt(self, value, field_name, context):
-        return "%s.get(%r, LaxNone) < %r" % (self.object_name, field_name, value)
+        return "%s < %r" % (self.field(field_name), value)
 
     def visit_lte(self, value, field_name, context):
-        return "%s.get(%r, LaxNone) <= %r" % (self.object_name, field_name, value)
+        return "%s <= %r" % (self.field(field_name), value)
 
     def visit_ne(self, value, field_name, context):
-        return "%s.get(%r, LaxNone) != %r" % (self.object_name, field_name, value)
+        return "%s != %r" % (self.field(field_name), value)
 
     def visit_eq(self, value, field_name, context):
-        return "%s.get(%r, LaxNone) == %r" % (self.object_name, field_name, value)
+        return "%s == %r" % (self.field(field_name), value)
 
     def visit_in(self, value, field_name, context, operator='in', juction='and'):
         if self.closure is None:
@@ -284,18 +680,21 @@ class LaxExprVisitor(BaseVisitor):
         else:
             var_name = "var%s" % len(self.closure)
             self.closure[var_name] = "{%s}" % ", ".join(repr(i) for i in value)
-        return "%r %s %s %s %s.get(%r, LaxNone) %s %s" % (
-            field_name, operator, self.object_name, juction, self.object_name, field_name, operator, var_name
+        return "%s %s %s %s %s" % (
+            self.exists(field_name, operator != 'in'), juction, self.field(field_name), operator, var_name
         )
 
     def visit_nin(self, value, field_name, context):
         return self.visit_in(value, field_name, context, 'not in', 'or')
 
-    def visit_and(self, parts, field_name, context, operator=' and '):
-        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context, operator)
+    def visit_and(self, parts, field_name, context, operator=' and ', disjunction=False):
+        return self.render_and([
+            self.visit_query(part, field_name)
+            for part in self.ordered(parts, field_name, disjunction)
+        ], field_name, context, operator)
 
     def visit_or(self, parts, field_name, context):
-        return self.visit_and(parts, field_name, context, ' or ')
+        return self.visit_and(parts, field_name, context, ' or ', True) if parts else 'False'
 
     def render_and(self, parts, field_name, context, operator=' and '):
         multiple = len(parts) > 1
@@ -306,53 +705,1050 @@ class LaxExprVisitor(BaseVisitor):
             return Skip
         else:
             regex, options = value
+            literal = literal_regex(regex, options)
 
-            if self.closure is None:
-                return "re.search(%r, %s.get(%r, ''), %d)" % (regex, self.object_name, field_name, options)
+            if literal is not None:
+                return render_literal(self.field(field_name, "''"), *literal)
+            elif self.closure is None:
+                return "re.search(%r, %s, %d)" % (regex, self.field(field_name, "''"), options)
             else:
                 var_name = "var%s" % len(self.closure)
-                self.closure[var_name] = "re.compile(%r, %d)" % (regex, options)
-                return "%s.search(%s.get(%r, ''))" % (var_name, self.object_name, field_name)
+                self.closure[var_name] = "compile_regex(%r, %d)" % (regex, options)
+                return "%s.search(%s)" % (var_name, self.field(field_name, "''"))
     visit_options = visit_regex
 
     def visit_size(self, value, field_name, context):
-        return "len(%s.get(%r, LaxNone)) == %r" % (self.object_name, field_name, value)
+        return "len(%s) == %r" % (self.field(field_name), value)
 
     def visit_all(self, value, field_name, context):
         if self.closure is None:
-            return 'set(%s.get(%r, LaxNone)) >= {%s}' % (self.object_name, field_name, ', '.join(repr(i) for i in value))
+            return 'set(%s) >= {%s}' % (self.field(field_name), ', '.join(repr(i) for i in value))
         else:
             var_name = "var%s" % len(self.closure)
             self.closure[var_name] = "{%s}" % ', '.join(repr(i) for i in value)
-            return 'set(%s.get(%r, LaxNone)) >= %s' % (self.object_name, field_name, var_name)
+            return 'set(%s) >= %s' % (self.field(field_name), var_name)
 
     def visit_mod(self, value, field_name, context):
         divisor, remainder = value
-        return '%s.get(%r, LaxNone) %% %s == %s' % (self.object_name, field_name, divisor, remainder)
+        return '%s %% %s == %s' % (self.field(field_name), divisor, remainder)
 
     def visit_exists(self, value, field_name, context):
-        return '%r %sin %s' % (
-            field_name, '' if value else 'not ', self.object_name,
+        return self.exists(field_name, not value)
+
+    def render_clause(self, part, field_name, operator):
+        if self.profile is None or part is Skip:
+            return part
+        return 'probe(%s, lambda: %s)' % (self.profile.add(field_name, operator, part), part)
+
+
+class CostModel(object):
+    """
+    Estimates the cost and the selectivity (the probability of being true) of the query clauses, so that the visitors
+    can order them: the clauses that are cheap and likely to short-circuit the evaluation go first.
+
+    The `stats` map ``(field_name, operator)`` to a selectivity. They can be given upfront or measured on some sample
+    rows with :meth:`collect`. Without stats the clauses are ordered by their cost alone.
+    """
+    default_cost = 5
+    default_selectivity = 0.5
+    costs = {
+        '$exists': 1, '$eq': 1, '$ne': 1,
+        '$gt': 2, '$gte': 2, '$lt': 2, '$lte': 2, '$mod': 2,
+        '$in': 3, '$nin': 3,
+        '$size': 4, '$all': 5, '$regex': 6,
+    }
+
+    def __init__(self, stats=None, costs=None):
+        self.stats = dict(stats or ())
+        self.observed = {}
+        if costs:
+            self.costs = dict(self.costs, **costs)
+
+    def key(self):
+        return tuple(sorted(self.costs.items())), tuple(sorted(self.stats.items()))
+
+    def observe(self, field_name, operator, evaluated, matched):
+        key = field_name, operator
+        total_evaluated, total_matched = self.observed.get(key, (0, 0))
+        total_evaluated += evaluated
+        total_matched += matched
+        self.observed[key] = total_evaluated, total_matched
+        if total_evaluated:
+            self.stats[key] = float(total_matched) / total_evaluated
+
+    def collect(self, query, rows):
+        """
+        Measures the selectivity of each clause in `query` on the given `rows`. Missing fields don't match.
+        """
+        rows = list(rows)
+        for field_name, operator, clause in self.clauses(query):
+            func = to_func(clause, lax=True)
+            self.observe(field_name, operator, len(rows), sum(1 for row in rows if func(row)))
+
+    def clauses(self, query, field_name=None):
+        for name, value in query.items():
+            if name in ('$and', '$or'):
+                for part in value:
+                    for clause in self.clauses(part, field_name):
+                        yield clause
+            elif name == '$regex':
+                clause = {name: value}
+                if '$options' in query:
+                    clause['$options'] = query['$options']
+                yield field_name, name, {field_name: clause}
+            elif name == '$options':
+                continue
+            elif name.startswith('$'):
+                yield field_name, name, {field_name: {name: value}}
+            elif isinstance(value, dict):
+                for clause in self.clauses(value, name):
+                    yield clause
+            else:
+                yield name, '$eq', {name: value}
+
+    def estimate(self, query, field_name=None, disjunction=False):
+        """
+        Returns a ``(cost, selectivity)`` estimate for `query` (a dict or a list of dicts).
+        """
+        if isinstance(query, dict):
+            estimates = [self.estimate_item(name, value, field_name) for name, value in query.items()]
+        else:
+            estimates = [self.estimate(part, field_name) for part in query]
+        cost, reached = 0, 1.0
+        for item_cost, selectivity in sorted(estimates, key=partial(self.rank, disjunction=disjunction)):
+            cost += reached * item_cost
+            reached *= 1 - selectivity if disjunction else selectivity
+        return cost, 1 - reached if disjunction else reached
+
+    def estimate_item(self, name, value, field_name):
+        if name in ('$and', '$or'):
+            return self.estimate(value, field_name, name == '$or')
+        elif name == '$options':
+            return 0, 1.0
+        elif name.startswith('$'):
+            return (
+                self.costs.get(name, self.default_cost),
+                self.stats.get((field_name, name), self.default_selectivity)
+            )
+        elif isinstance(value, dict):
+            return self.estimate(value, name)
+        else:
+            return self.costs['$eq'], self.stats.get((name, '$eq'), self.default_selectivity)
+
+    def rank(self, estimate, disjunction=False):
+        cost, selectivity = estimate
+        short_circuit = selectivity if disjunction else 1 - selectivity
+        return cost / short_circuit if short_circuit else float('inf')
+
+    def sort_items(self, items, field_name):
+        return sorted(items, key=lambda item: self.rank(self.estimate_item(item[0], item[1], field_name)))
+
+    def sort_queries(self, parts, field_name, disjunction=False):
+        return sorted(parts, key=lambda part: self.rank(self.estimate(part, field_name), disjunction))
+
+
+ClauseStats = namedtuple('ClauseStats', ['field_name', 'operator', 'source', 'evaluated', 'matched', 'time'])
+
+
+class Profile(object):
+    """
+    The counters of a function made with ``profile=True``: how many times each clause was evaluated, how many times it
+    was true and the time spent in it (in seconds). The clauses are numbered in the order they are rendered.
+    """
+    timer = staticmethod(default_timer)
+
+    def __init__(self):
+        self.clauses = []
+        self.counters = []
+        self.closure = OrderedDict()
+
+    def add(self, field_name, operator, source):
+        self.clauses.append((field_name, operator, source))
+        self.counters.append([0, 0, 0.0])
+        return len(self.clauses) - 1
+
+    def probe(self, index, clause):
+        start = self.timer()
+        result = clause()
+        elapsed = self.timer() - start
+        counters = self.counters[index]
+        counters[0] += 1
+        if result:
+            counters[1] += 1
+        counters[2] += elapsed
+        return result
+
+    def reset(self):
+        for counters in self.counters:
+            counters[:] = 0, 0, 0.0
+
+    def results(self):
+        return [ClauseStats(*clause + tuple(counters)) for clause, counters in zip(self.clauses, self.counters)]
+
+    def stats(self):
+        """
+        Gives back the measured selectivity of the clauses, in the format :class:`CostModel` takes.
+        """
+        totals = OrderedDict()
+        for result in self.results():
+            if result.evaluated:
+                key = result.field_name, result.operator
+                evaluated, matched = totals.get(key, (0, 0))
+                totals[key] = evaluated + result.evaluated, matched + result.matched
+        return dict((key, float(matched) / evaluated) for key, (evaluated, matched) in totals.items())
+
+    def explain(self):
+        """
+        Gives back a report with the clauses (in the order they are rendered), their counters and the sizes of the
+        values bound to the function.
+        """
+        lines = ['%3s %9s %9s %11s %10s  %s' % ('#', 'evaluated', 'matched', 'selectivity', 'time', 'clause')]
+        for index, result in enumerate(self.results()):
+            lines.append('%3s %9s %9s %11s %10.6f  %s' % (
+                index, result.evaluated, result.matched,
+                '%.3f' % (float(result.matched) / result.evaluated) if result.evaluated else '-',
+                result.time, result.source,
+            ))
+        for name, value in self.closure.items():
+            lines.append('%s: %s' % (name, '%s values' % len(value) if hasattr(value, '__len__') else repr(value)))
+        return '\n'.join(lines)
+
+
+class Normalizer(object):
+    """
+    Rewrites a query to a simpler equivalent query:
+
+    * nested ``$and``/``$or`` are flattened,
+    * the ranges, equalities, ``$in`` and ``$nin`` on the same field are merged,
+    * ``$or`` branches that are equalities on the same field are turned into a ``$in``,
+    * contradictions and tautologies are folded (to ``{"$or": []}`` - never matches and ``{}`` - always matches).
+
+    Values of different types are left alone (eg: a ``$gt`` with a number and a ``$lt`` with a string), and so are the
+    operators the normalizer doesn't know about.
+    """
+    mergeable = '$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists'
+
+    def normalize(self, query):
+        return self.render(self.simplify(self.parse(query)))
+
+    def parse(self, query, field_name=None):
+        nodes = []
+        for name, value in query.items():
+            if name in ('$and', '$or') and isinstance(value, (list, tuple)) and all(isinstance(i, dict) for i in value):
+                nodes.append((name, [self.parse(part, field_name) for part in value]))
+            elif field_name is None:
+                if name.startswith('$'):
+                    nodes.append((None, name, value))
+                elif isinstance(value, dict) and all(key.startswith('$') for key in value):
+                    nodes.append(self.parse(value, name))
+                elif isinstance(value, dict):
+                    nodes.append((name, None, value))
+                else:
+                    nodes.append((name, '$eq', value))
+            elif name == '$regex':
+                nodes.append((field_name, name, dict((key, query[key]) for key in ('$regex', '$options') if key in query)))
+            elif name == '$options' and '$regex' in query:
+                continue
+            else:
+                nodes.append((field_name, name, value))
+        return '$and', nodes
+
+    def simplify(self, node):
+        if node is True or node is False or len(node) == 3:
+            return self.simplify_and([node])
+        operator, children = node
+        children = [self.simplify(child) for child in children]
+        if operator == '$and':
+            return self.simplify_and(children)
+        else:
+            return self.simplify_or(children)
+
+    def flatten(self, operator, children):
+        for child in children:
+            if isinstance(child, tuple) and len(child) == 2 and child[0] == operator:
+                for grandchild in child[1]:
+                    yield grandchild
+            else:
+                yield child
+
+    def simplify_and(self, children):
+        fields = OrderedDict()
+        parts = []
+        for child in self.flatten('$and', children):
+            if child is False:
+                return False
+            elif child is True:
+                continue
+            elif len(child) == 3 and child[0] is not None and self.is_mergeable(*child):
+                if child[0] not in fields:
+                    fields[child[0]] = []
+                    parts.append((child[0],))
+                fields[child[0]].append(child)
+            else:
+                parts.append(child)
+        children = []
+        for part in parts:
+            if len(part) == 1:
+                merged = self.merge_field(fields[part[0]])
+                if merged is False:
+                    return False
+                children.extend(merged)
+            else:
+                children.append(part)
+        if not children:
+            return True
+        elif len(children) == 1:
+            return children[0]
+        else:
+            return '$and', children
+
+    def simplify_or(self, children):
+        fields = OrderedDict()
+        parts = []
+        for child in self.flatten('$or', children):
+            if child is True:
+                return True
+            elif child is False:
+                continue
+            elif len(child) == 3 and child[0] is not None and child[1] in ('$eq', '$in') and self.is_mergeable(*child):
+                if child[0] not in fields:
+                    fields[child[0]] = []
+                    parts.append((child[0],))
+                fields[child[0]].append(child)
+            else:
+                parts.append(child)
+        children = []
+        for part in parts:
+            leaves = fields[part[0]] if len(part) == 1 else ()
+            if len(leaves) == 1:
+                children.append(leaves[0])
+            elif leaves:
+                values = self.unique(
+                    value for _, operator, value in leaves
+                    for value in (value if operator == '$in' else (value,))
+                )
+                children.append((part[0], '$eq', values[0]) if len(values) == 1 else (part[0], '$in', values))
+            else:
+                children.append(part)
+        if not children:
+            return False
+        elif len(children) == 1:
+            return children[0]
+        else:
+            return '$or', children
+
+    def unique(self, values):
+        seen = set()
+        return [value for value in values if not (value in seen or seen.add(value))]
+
+    def kind(self, value):
+        if isinstance(value, bool):
+            return
+        elif isinstance(value, (int, float) if sys.version_info[0] == 3 else (int, long, float)):  # noqa
+            return 'number' if value == value else None
+        elif isinstance(value, (str, type(u''))):
+            return 'string'
+
+    def is_mergeable(self, field_name, operator, value):
+        if operator not in self.mergeable:
+            return False
+        elif operator in ('$in', '$nin'):
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                return False
+            values = value
+        elif operator == '$exists':
+            return True
+        else:
+            values = value,
+        try:
+            set(values)
+        except TypeError:
+            return False
+        return all(self.kind(value) is not None for value in values)
+
+    def merge_field(self, leaves):
+        field_name = leaves[0][0]
+        kinds = set(
+            self.kind(value)
+            for _, operator, value in leaves if operator != '$exists'
+            for value in (value if operator in ('$in', '$nin') else (value,))
         )
+        if len(kinds) > 1:
+            return leaves
+
+        equal = lower = upper = allowed = exists = None
+        excluded, unequal = [], []
+        for _, operator, value in leaves:
+            if operator == '$eq':
+                if equal is not None and equal[0] != value:
+                    return False
+                equal = value,
+            elif operator in ('$gt', '$gte'):
+                if lower is None or value > lower[0] or value == lower[0] and operator == '$gt':
+                    lower = value, operator
+            elif operator in ('$lt', '$lte'):
+                if upper is None or value < upper[0] or value == upper[0] and operator == '$lt':
+                    upper = value, operator
+            elif operator == '$in':
+                allowed = self.unique(value) if allowed is None else [i for i in allowed if i in set(value)]
+            elif operator == '$ne':
+                unequal.append(value)
+            elif operator == '$nin':
+                excluded.extend(value)
+            elif operator == '$exists':
+                if exists is not None and exists != bool(value):
+                    return False
+                exists = bool(value)
+
+        if exists is False:
+            if equal or lower or upper or allowed is not None:
+                return False
+            return leaves
+
+        def acceptable(value):
+            return (
+                value not in excluded and value not in unequal and
+                (lower is None or value > lower[0] or value == lower[0] and lower[1] == '$gte') and
+                (upper is None or value < upper[0] or value == upper[0] and upper[1] == '$lte')
+            )
+
+        if equal is not None and allowed is not None:
+            allowed = [equal[0]] if equal[0] in allowed else []
+        elif equal is not None:
+            allowed = [equal[0]]
+        elif lower and upper and lower[0] == upper[0]:
+            allowed = [lower[0]]
+        elif lower and upper and lower[0] > upper[0]:
+            return False
+
+        merged = [(field_name, '$exists', True)] if exists else []
+        if allowed is not None:
+            allowed = [value for value in allowed if acceptable(value)]
+            if not allowed:
+                return False
+            elif len(allowed) == 1:
+                merged.append((field_name, '$eq', allowed[0]))
+            else:
+                merged.append((field_name, '$in', allowed))
+        else:
+            if lower:
+                merged.append((field_name, lower[1], lower[0]))
+            if upper:
+                merged.append((field_name, upper[1], upper[0]))
+            # a missing field matches $nin but not $ne in lax mode, so they are kept apart
+            for operator, values in ('$ne', unequal), ('$nin', excluded):
+                values = self.unique(
+                    value for value in values
+                    if (lower is None or value >= lower[0]) and (upper is None or value <= upper[0])
+                )
+                if operator == '$nin' and values:
+                    merged.append((field_name, operator, values))
+                elif operator == '$ne':
+                    merged.extend((field_name, operator, value) for value in values)
+        return merged
+
+    def render(self, node):
+        if node is True:
+            return {}
+        elif node is False:
+            return {'$or': []}
+        elif len(node) == 3:
+            return self.render_and([node])
+        elif node[0] == '$or':
+            return {'$or': [self.render(child) for child in node[1]]}
+        else:
+            return self.render_and(node[1])
+
+    def render_and(self, children):
+        query = {}
+        extra = []
+        for child in children:
+            if len(child) == 2:
+                if child[0] == '$or' and '$or' not in query:
+                    query['$or'] = self.render(child)['$or']
+                else:
+                    extra.append(self.render(child))
+                continue
+            field_name, operator, value = child
+            if field_name is None or operator is None:
+                key = operator if field_name is None else field_name
+                if key in query:
+                    extra.append({key: value})
+                else:
+                    query[key] = value
+                continue
+            if operator == '$regex':
+                clause = value
+            elif operator == '$eq' and field_name not in query and not isinstance(value, dict):
+                query[field_name] = value
+                continue
+            else:
+                clause = {operator: value}
+            existing = query.setdefault(field_name, {})
+            if not isinstance(existing, dict) or set(existing) & set(clause):
+                extra.append({field_name: clause})
+            else:
+                existing.update(clause)
+        if extra:
+            query['$and'] = extra
+        return query
 
 
-def to_string(query, closure=None, object_name='row', lax=False):
-    visitor = (LaxExprVisitor if lax else ExprVisitor)(closure, object_name)
+normalize = Normalizer().normalize
+
+
+def to_string(query, closure=None, object_name='row', lax=False, cost_model=None, normalize=False, schema=None,
+              trusted=False):
+    if normalize:
+        query = Normalizer().normalize(query)
+    visitor = (LaxExprVisitor if lax else ExprVisitor)(
+        closure, object_name, cost_model, schema=make_schema(schema), trusted=trusted
+    )
     return visitor.visit(query)
 
 
-def to_func(query, use_arguments=True, lax=False):
+def _canonical(value):
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted('%s: %s' % (_canonical(k), _canonical(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_canonical(i) for i in value)
+    elif isinstance(value, (set, frozenset)):
+        return '{%s}' % ', '.join(sorted(_canonical(i) for i in value))
+    else:
+        return '%s:%r' % (type(value).__name__, value)
+
+
+def fingerprint(query):
+    """
+    Returns a stable digest of `query` that doesn't depend on dict ordering. Values of different types (eg: ``1`` and
+    ``True``) give different fingerprints.
+    """
+    return hashlib.sha1(_canonical(query).encode('utf8')).hexdigest()
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'size', 'maxsize'])
+
+
+class QueryCache(object):
+    """
+    A bounded cache for the functions made by :func:`to_func`. The least recently used entry is evicted when there are
+    more than `maxsize` entries. If `ttl` is given, entries older than `ttl` seconds are evicted too.
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self.entries), self.maxsize)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return
+            func, created = entry
+            if self.ttl is not None and self.timer() - created > self.ttl:
+                self.evict(func)
+                self.misses += 1
+                return
+            self.entries[key] = entry
+            self.hits += 1
+            return func
+
+    def set(self, key, func):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = func, self.timer()
+            while len(self.entries) > self.maxsize:
+                self.evict(self.entries.pop(next(iter(self.entries)))[0])
+
+    def evict(self, func):
+        linecache.cache.pop(func.__code__.co_filename, None)
+        self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for func, _ in self.entries.values():
+                linecache.cache.pop(func.__code__.co_filename, None)
+            self.entries.clear()
+
+
+Pattern = type(re.compile(''))
+replace_file = getattr(os, 'replace', os.rename)
+
+
+def dump_value(value):
+    if isinstance(value, Pattern):
+        flags = int(value.flags) & ~int(re.UNICODE) if isinstance(value.pattern, str) else int(value.flags)
+        return 'pattern', value.pattern, flags
+    else:
+        return 'value', value
+
+
+def load_value(value):
+    if value[0] == 'pattern':
+        return compile_regex(value[1], value[2])
+    else:
+        return value[1]
+
+
+class DiskCache(object):
+    """
+    A cache for the functions made by :func:`to_func` and :func:`to_filter` that keeps them in files in `directory`, as
+    marshalled code objects along with the values bound to them. Other processes can load them instead of compiling the
+    queries again. The files are written atomically. The files made by another version of the library (or of Python)
+    are ignored and removed. The least recently used files are removed when there are more than `maxsize` files or
+    when they take more than `max_bytes` bytes. Functions that can't be stored (made with ``codegen="ast"`` or
+    ``profile=True``, or bound to values that can't be marshalled) aren't cached.
+
+    The files are loaded and run as code, so `directory` must be private and trusted: anyone that can write in it can
+    run code in the processes that use the cache. A missing `directory` is created with ``0o700`` permissions.
+    """
+    suffix = '.mqc'
+
+    def __init__(self, directory, maxsize=None, max_bytes=None):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.header = MAGIC_NUMBER + ('mongoql_conv %s\n' % __version__).encode('ascii')
+        self.hits = self.misses = self.evictions = 0
+        self.lock = RLock()
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        self.files = OrderedDict(self.scan())
+        self.size = sum(self.files.values())
+
+    def scan(self):
+        """
+        Gives back the ``(name, size)`` pairs of the files in the directory, least recently used first.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, name, stat.st_size))
+        return [(name, size) for _, name, size in sorted(files)]
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, key):
+        return self.filename(key) in self.files
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self.files), self.maxsize)
+
+    def filename(self, key):
+        return hashlib.sha1(repr(key).encode('utf8')).hexdigest() + self.suffix
+
+    def get(self, key):
+        name = self.filename(key)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except (IOError, OSError):
+            func = None
+        else:
+            func = self.load(key, data)
+            if func is None:
+                self.remove(name)
+        with self.lock:
+            if func is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            if name in self.files:
+                self.files[name] = self.files.pop(name)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return func
+
+    def load(self, key, data):
+        if not data.startswith(self.header):
+            return
+        try:
+            key_repr, code, defaults, query, source = marshal.loads(data[len(self.header):])
+        except (ValueError, EOFError, TypeError):
+            return
+        if key_repr != repr(key):
+            return
+        func = FunctionType(code, globals(), code.co_name, tuple(load_value(value) for value in defaults) or None)
+        return register(func, query, source)
+
+    def set(self, key, func):
+        if func.__globals__ is not globals() or func.__closure__:
+            return
+        try:
+            payload = marshal.dumps((
+                repr(key), func.__code__, tuple(dump_value(value) for value in func.__defaults__ or ()),
+                func.query, func.source,
+            ))
+        except ValueError:
+            return
+        data = self.header + payload
+        name = self.filename(key)
+        handle, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(data)
+            replace_file(temp, os.path.join(self.directory, name))
+        except BaseException:
+            os.remove(temp)
+            raise
+        with self.lock:
+            self.size -= self.files.pop(name, 0)
+            self.files[name] = len(data)
+            self.size += len(data)
+            while self.files and (
+                self.maxsize is not None and len(self.files) > self.maxsize or
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                self.remove(next(iter(self.files)))
+                self.evictions += 1
+
+    def remove(self, name):
+        with self.lock:
+            self.size -= self.files.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            for name, _ in self.scan():
+                self.remove(name)
+
+
+FILTERS = {
+    'list': "[item for item in items if %s]",
+    'iter': "(item for item in items if %s)",
+    'count': "sum(1 for item in items if %s)",
+    'first': "next((item for item in items if %s), None)",
+}
+
+#: The statements used instead of the :data:`FILTERS` when a function body is needed: before the loop, for each
+#: matching item and after the loop.
+FILTER_BODIES = {
+    FILTERS['list']: (['result = []'], ['result.append(item)'], ['return result']),
+    FILTERS['iter']: ([], ['yield item'], []),
+    FILTERS['count']: (['result = 0'], ['result += 1'], ['return result']),
+    FILTERS['first']: ([], ['return item'], []),
+}
+
+CODEGENS = 'string', 'ast'
+
+
+#: How many times the lax functions look up the field for each operator (once for the other operators).
+LAX_LOOKUPS = {'$in': 2, '$nin': 2}
+
+
+def field_uses(query, uses, field_name=None, weights=None):
+    """
+    Counts how many times each field is used in `query` (invalid parts are ignored, the visitors report them). The
+    operators in `weights` count as that many uses.
+    """
+    for name, value in query.items():
+        if not isinstance(name, string_types):
+            continue
+        elif name in ('$and', '$or') and isinstance(value, (list, tuple)):
+            for part in value:
+                if isinstance(part, dict):
+                    field_uses(part, uses, field_name, weights)
+        elif name.startswith('$'):
+            if field_name is not None and name != '$options':
+                uses[field_name] = uses.get(field_name, 0) + (weights.get(name, 1) if weights else 1)
+        elif isinstance(value, dict):
+            field_uses(value, uses, name, weights)
+        else:
+            uses[name] = uses.get(name, 0) + 1
+    return uses
+
+
+def shared_prefixes(query):
+    """
+    Gives back the subdocuments (key tuples) that more than one clause of `query` looks into, shortest first. A prefix
+    that's only used through a longer shared prefix is left out.
+    """
+    counts = {}
+    for field_name, uses in field_uses(query, {}).items():
+        keys = split_path(field_name)
+        for position in range(1, len(keys)):
+            counts[keys[:position]] = counts.get(keys[:position], 0) + uses
+    shared = set(keys for keys, uses in counts.items() if uses > 1)
+    for keys in list(shared):
+        if keys[:-1] in shared and counts[keys] == counts[keys[:-1]]:
+            shared.discard(keys[:-1])
+    return sorted(shared, key=len)
+
+
+def hoist(prefixes, lax=False, schema=None):
+    """
+    Makes the statements that load the subdocuments at `prefixes` in locals. Gives back the statements and a mapping of
+    prefixes to local names.
+    """
+    hoisted = OrderedDict()
+    lines = []
+    for keys in prefixes:
+        var_name = 'path%s' % len(hoisted)
+        if lax:
+            lines.append('%s = %s' % (var_name, render_path('item', keys, hoisted, True, schema)))
+        else:
+            lines.extend([
+                'try:',
+                '    %s = %s' % (var_name, render_path('item', keys, hoisted, schema=schema)),
+                'except (LookupError, TypeError, AttributeError) as exc:',
+                '    %s = Unresolved(exc)' % var_name,
+            ])
+        hoisted[keys] = var_name
+    return lines, hoisted
+
+
+def shared_fields(query):
+    """
+    Gives back the fields (not the ones in subdocuments) that the lax function for `query` would look up more than
+    once.
+    """
+    uses = field_uses(query, {}, weights=LAX_LOOKUPS)
+    return sorted(name for name, count in uses.items() if count > 1 and len(split_path(name)) == 1)
+
+
+def load_fields(names, schema=None):
+    """
+    Makes the statements that load the fields in `names` (as the lax functions look them up) in locals. Gives back the
+    statements and a mapping of field names to local names.
+    """
+    loaded = OrderedDict()
+    lines = []
+    for name in names:
+        var_name = 'field%s' % len(loaded)
+        lines.append('%s = %s' % (var_name, (schema or MAPPING).field('item', name, True)))
+        loaded[name] = var_name
+    return lines, loaded
+
+
+def indent(lines):
+    return ['    ' + line for line in lines]
+
+
+def compile_query(query, argument, template, use_arguments=True, lax=False, cache=None, cost_model=None,
+                  normalize=False, codegen='string', schema=None, profile=False, trusted=False):
+    if codegen not in CODEGENS:
+        raise ValueError("Invalid codegen %r. Must be one of: %s." % (codegen, ', '.join(CODEGENS)))
+    schema = make_schema(schema)
+    if cache is not None:
+        key = (fingerprint(query), argument, template, use_arguments, lax, cost_model and cost_model.key(), normalize,
+               codegen, schema.key(), profile, trusted)
+        func = cache.get(key)
+        if func is None:
+            func = compile_query(
+                query, argument, template, use_arguments, lax, None, cost_model, normalize, codegen, schema, profile,
+                trusted
+            )
+            cache.set(key, func)
+        return func
+    profile = Profile() if profile else None
+    if codegen == 'ast':
+        from .codegen import compile_ast
+        func = compile_ast(
+            query, argument, template, use_arguments, lax, cost_model, normalize, schema, profile, trusted
+        )
+        return attach_profile(func, profile)
     closure = {} if use_arguments else None
-    as_string = to_string(query, closure, object_name='item', lax=lax)
-    as_code = "lambda item%s: (%s) # compiled from %r" % (
-        ', ' + ', '.join('%s=%s' % (var_name, value) for var_name, value in closure.items()) if closure else '',
-        as_string,
-        query
+    visited = Normalizer().normalize(query) if normalize else query
+    lines, hoisted = hoist(shared_prefixes(visited), lax, schema)
+    if lax:
+        loads, loaded = load_fields(shared_fields(visited), schema)
+        visitor = LaxExprVisitor(closure, 'item', cost_model, hoisted, schema, profile, trusted, loaded)
+        lines += loads
+    else:
+        visitor = ExprVisitor(closure, 'item', cost_model, hoisted, schema, profile, trusted)
+    as_string = visitor.visit(visited)
+    arguments = argument + (
+        ', ' + ', '.join('%s=%s' % (var_name, value) for var_name, value in closure.items()) if closure else ''
     )
-    filename = "<query-function-%x>" % zlib.adler32(as_string.encode('utf8'))
-    func = eval(compile(as_code, filename, 'eval'))
-    linecache.cache[filename] = len(as_code), None, [as_code], filename
+    if not lines:
+        as_code = "lambda %s: (%s) # compiled from %r" % (arguments, template % as_string, query)
+    elif template == '%s':
+        as_code = "# compiled from %r\ndef query(%s):\n%s\n" % (query, arguments, '\n'.join(indent(
+            lines + ['return %s' % as_string]
+        )))
+    else:
+        before, action, after = FILTER_BODIES[template]
+        as_code = "# compiled from %r\ndef query(%s):\n%s\n" % (query, arguments, '\n'.join(indent(
+            before + ['for item in items:'] + indent(lines + ['if %s:' % as_string] + indent(action)) + after
+        )))
+    filename = "<query-function-%x>" % zlib.adler32(as_code.encode('utf8'))
+    namespace = globals() if profile is None else dict(globals(), probe=profile.probe)
+    if lines:
+        scope = {}
+        exec_(compile(as_code, filename, 'exec'), namespace, scope)
+        func = scope['query']
+    else:
+        func = eval(compile(as_code, filename, 'eval'), namespace)
+    return attach_profile(register(func, query, as_code), profile)
+
+
+def register(func, query, source):
+    """
+    Adds the `source` of `func` to :mod:`linecache` (for tracebacks) until `func` is gone.
+    """
+    filename = func.__code__.co_filename
+    linecache.cache[filename] = len(source), None, source.splitlines(True), filename
     func.query = query
-    func.source = as_code
+    func.source = source
     func.cleanup = weakref.ref(func, lambda _, filename=filename: linecache.cache.pop(filename, None))
     return func
+
+
+def attach_profile(func, profile):
+    """
+    Exposes the `profile` (if any) on `func`, along with the values bound to it.
+    """
+    if profile is not None:
+        code = func.__code__
+        profile.closure.update(zip(code.co_varnames[1:code.co_argcount], func.__defaults__ or ()))
+        func.profile = profile
+        func.stats = profile.stats
+        func.explain = profile.explain
+    return func
+
+
+def to_func(query, use_arguments=True, lax=False, cache=None, cost_model=None, normalize=False, codegen='string',
+            schema=None, profile=False, trusted=False):
+    """
+    Makes a function that tells if an item matches the `query`. The items are mappings unless a `schema` is given:
+    a list of column names for sequences (like the rows of a DB-API cursor), ``"attribute"`` for objects, or a class (a
+    namedtuple class is the same as its list of fields, any other class is the same as ``"attribute"``).
+
+    With `profile` each clause is counted and timed (see :class:`Profile`). With `trusted` the query isn't validated
+    (only for queries that are known to be valid, like the ones that were compiled before).
+    """
+    return compile_query(
+        query, 'item', '%s', use_arguments, lax, cache, cost_model, normalize, codegen, schema, profile, trusted
+    )
+
+
+def to_filter(query, kind='list', use_arguments=True, lax=False, cache=None, cost_model=None, normalize=False,
+              codegen='string', schema=None, profile=False, trusted=False):
+    """
+    Like :func:`to_func` but the loop over the items is in the generated code, so there's no function call for each
+    item. The `kind` can be ``"list"``, ``"iter"`` (a generator), ``"count"`` or ``"first"`` (the first matching item
+    or ``None``).
+    """
+    if kind not in FILTERS:
+        raise ValueError("Invalid kind %r. Must be one of: %s." % (kind, ', '.join(sorted(FILTERS))))
+    return compile_query(
+        query, 'items', FILTERS[kind], use_arguments, lax, cache, cost_model, normalize, codegen, schema, profile,
+        trusted
+    )
+
+
+class CompiledQuery(object):
+    """
+    A picklable alternative to the function made by :func:`to_func`. Only the query and the options get pickled, the
+    functions are compiled when first needed (through a cache shared by all the instances in the process).
+    """
+    cache = QueryCache()
+
+    def __init__(self, query, use_arguments=True, lax=False):
+        self.query = query
+        self.use_arguments = use_arguments
+        self.lax = lax
+        self._func = self._filter = None
+
+    def __getstate__(self):
+        return self.query, self.use_arguments, self.lax
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "CompiledQuery(%r, use_arguments=%r, lax=%r)" % (self.query, self.use_arguments, self.lax)
+
+    @property
+    def func(self):
+        if self._func is None:
+            self._func = to_func(self.query, self.use_arguments, self.lax, self.cache)
+        return self._func
+
+    def __call__(self, item):
+        return self.func(item)
+
+    def filter(self, items):
+        if self._filter is None:
+            self._filter = to_filter(self.query, 'list', self.use_arguments, self.lax, self.cache)
+        return self._filter(items)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def parallel_filter(query, iterable, workers=None, chunksize=10000, ordered=True, use_arguments=True, lax=False,
+                    pool=None):
+    """
+    Filters `iterable` in a pool of processes, `chunksize` items at a time. Gives back a generator. If `ordered` is
+    false then the items come in the order the chunks are completed.
+
+    The `query` can be a dict or a :class:`CompiledQuery`. You can give an existing `pool` (anything with
+    ``imap``/``imap_unordered``, like ``multiprocessing.Pool``), otherwise a pool with `workers` processes is created
+    (defaults to the number of CPUs).
+    """
+    if not isinstance(query, CompiledQuery):
+        query = CompiledQuery(query, use_arguments, lax)
+    query.func  # validate the query before starting any work
+    return _parallel_filter(query, iterable, workers, chunksize, ordered, pool)
+
+
+def _parallel_filter(query, iterable, workers, chunksize, ordered, pool):
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(workers)
+    try:
+        results = (pool.imap if ordered else pool.imap_unordered)(partial(_filter_chunk, query), chunked(iterable, chunksize))
+        for result in results:
+            for item in result:
+                yield item
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def _filter_chunk(query, chunk):
+    return query.filter(chunk)
+
+
+from .collection import Collection  # noqa isort:skip
+from .matcher import QueryMatcher  # noqa isort:skip
+from .pruning import can_match  # noqa isort:skip
+from .pruning import collect_stats  # noqa isort:skip
+from .results import ResultCache  # noqa isort:skip
+from .results import implies  # noqa isort:skip
+from .live import LiveQuery  # noqa isort:skip
+from .cursor import find  # noqa isort:skip
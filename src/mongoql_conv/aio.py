@@ -0,0 +1,96 @@
+"""
+Filters asynchronous iterables (eg: change stream like feeds) in batches, so the query is evaluated on a whole batch at a
+time and the event loop only waits once for each batch. Requires Python 3.6.
+"""
+from __future__ import absolute_import
+
+import asyncio
+
+from mongoql_conv import CompiledQuery
+
+try:
+    get_running_loop = asyncio.get_running_loop
+except AttributeError:  # Python 3.6
+    get_running_loop = asyncio.get_event_loop
+
+
+class Failure(object):
+    """
+    Carries an error raised while reading the source to the consumer.
+    """
+    def __init__(self, error):
+        self.error = error
+
+
+End = object()
+
+
+async def batches(aiterable, batch_size):
+    batch = []
+    async for item in aiterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def read_ahead(aiterable, batch_size, queue):
+    try:
+        async for batch in batches(aiterable, batch_size):
+            await queue.put(batch)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        await queue.put(Failure(exc))
+    else:
+        await queue.put(End)
+
+
+async def queued(aiterable, batch_size, queue_size):
+    """
+    Reads the batches in a task, at most `queue_size` batches ahead of the consumer (the source isn't read while the
+    queue is full).
+    """
+    queue = asyncio.Queue(queue_size)
+    task = asyncio.ensure_future(read_ahead(aiterable, batch_size, queue))
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is End:
+                break
+            elif isinstance(batch, Failure):
+                raise batch.error
+            yield batch
+    finally:
+        task.cancel()
+
+
+async def afilter(query, aiterable, batch_size=100, queue_size=0, executor=None, offload_size=1000,
+                  use_arguments=True, lax=False):
+    """
+    Gives back an asynchronous generator of the items in `aiterable` that match the `query` (a dict or a
+    :class:`mongoql_conv.CompiledQuery`). The items are read in batches of `batch_size` (the last one can be smaller)
+    and each batch is filtered at once.
+
+    With `queue_size` the source is read in a separate task, up to `queue_size` batches ahead, so reading overlaps with
+    filtering and consuming the items. Batches of at least `offload_size` items are filtered in the `executor` (a
+    thread or a process pool, see :meth:`asyncio.loop.run_in_executor`) if one is given, so the event loop isn't
+    blocked by big batches.
+    """
+    if not isinstance(query, CompiledQuery):
+        query = CompiledQuery(query, use_arguments, lax)
+    query.func  # validate the query before reading anything
+    loop = get_running_loop()
+    source = queued(aiterable, batch_size, queue_size) if queue_size else batches(aiterable, batch_size)
+    try:
+        async for batch in source:
+            if executor is not None and len(batch) >= offload_size:
+                matched = await loop.run_in_executor(executor, query.filter, batch)
+            else:
+                matched = query.filter(batch)
+            for item in matched:
+                yield item
+    finally:
+        await source.aclose()
@@ -0,0 +1,296 @@
+"""
+Filters Arrow tables and Parquet files (requires ``pyarrow``). The query is turned into a :mod:`pyarrow.compute`
+expression where Arrow can evaluate it and the rest of the query (the residual) is matched with ``to_func``. Null
+values are treated as missing fields: the rows match like the dicts without their null fields match with
+``to_func(query, lax=True)``.
+"""
+from __future__ import absolute_import
+
+import datetime
+import re
+from collections import namedtuple
+from decimal import Decimal
+from functools import reduce
+from operator import and_
+from operator import or_
+
+import pyarrow
+import pyarrow.compute as compute
+import pyarrow.parquet as parquet
+import pyarrow.types as types
+
+from mongoql_conv import BaseVisitor
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+from mongoql_conv import can_match
+from mongoql_conv import field_uses
+from mongoql_conv import literal_regex
+from mongoql_conv import split_path
+from mongoql_conv import to_func
+
+
+class Pushdown(namedtuple('Pushdown', ['expression', 'residual'])):
+    """
+    A query split for Arrow: `expression` is a :class:`pyarrow.compute.Expression` and `residual` is a list of queries
+    that the rows selected by the expression must still match.
+    """
+    __slots__ = ()
+
+
+TRUE = compute.scalar(True)
+FALSE = compute.scalar(False)
+
+#: The name of the column that holds the row numbers while a row group is filtered.
+INDEX = '__mongoql_conv_index__'
+
+
+def compatible(value, column_type):
+    """
+    Checks if Arrow compares `value` with a column of `column_type` like Python does.
+    """
+    if isinstance(value, bool):
+        return types.is_boolean(column_type)
+    elif isinstance(value, (int, float, Decimal)) or type(value).__name__ == 'long':
+        return types.is_integer(column_type) or types.is_floating(column_type) or types.is_decimal(column_type)
+    elif isinstance(value, str):
+        return types.is_string(column_type) or types.is_large_string(column_type)
+    elif isinstance(value, bytes):
+        return types.is_binary(column_type) or types.is_large_binary(column_type)
+    elif isinstance(value, datetime.datetime):
+        return types.is_timestamp(column_type) and (value.tzinfo is None) == (column_type.tz is None)
+    elif isinstance(value, datetime.date):
+        return types.is_date(column_type)
+    return False
+
+
+def resolve_type(schema, keys):
+    """
+    Gives back the type of the (nested) field at `keys`, ``None`` if the field can't be looked up in struct columns.
+    """
+    column_type = schema.field(keys[0]).type
+    for key in keys[1:]:
+        if not types.is_struct(column_type) or column_type.get_field_index(key) < 0:
+            return
+        column_type = column_type.field(key).type
+    return column_type
+
+
+class ExpressionVisitor(BaseVisitor):
+    """
+    Makes a :class:`Pushdown` for a query over tables with the given `schema` (a :class:`pyarrow.Schema`).
+    """
+    def __init__(self, schema):
+        self.schema = schema
+
+    def residual(self, field_name, clause):
+        return Pushdown(TRUE, [{field_name: clause}])
+
+    def pushdown(self, field_name, clause, values, make):
+        """
+        Gives back a :class:`Pushdown` with the expression made by `make` (called with the field) for the `clause`, if
+        all the `values` are compatible with the field's column. Fields that aren't in the schema are matched once,
+        against an empty row.
+        """
+        keys = split_path(field_name)
+        if keys[0] not in self.schema.names:
+            try:
+                matched = to_func({field_name: clause}, lax=True)({})
+            except Exception:
+                return self.residual(field_name, clause)
+            return Pushdown(compute.scalar(bool(matched)), [])
+        column_type = resolve_type(self.schema, keys)
+        if column_type is None or not all(compatible(item, column_type) for item in values):
+            return self.residual(field_name, clause)
+        return Pushdown(make(compute.field(*keys)), [])
+
+    def visit_gt(self, value, field_name, context):
+        return self.pushdown(field_name, {'$gt': value}, [value], lambda field: field > value)
+
+    def visit_gte(self, value, field_name, context):
+        return self.pushdown(field_name, {'$gte': value}, [value], lambda field: field >= value)
+
+    def visit_lt(self, value, field_name, context):
+        return self.pushdown(field_name, {'$lt': value}, [value], lambda field: field < value)
+
+    def visit_lte(self, value, field_name, context):
+        return self.pushdown(field_name, {'$lte': value}, [value], lambda field: field <= value)
+
+    def visit_ne(self, value, field_name, context):
+        return self.pushdown(field_name, {'$ne': value}, [value], lambda field: field != value)
+
+    def visit_eq(self, value, field_name, context):
+        return self.pushdown(field_name, {'$eq': value}, [value], lambda field: field == value)
+
+    def visit_in(self, value, field_name, context):
+        return self.pushdown(field_name, {'$in': value}, value, lambda field: (
+            field.isin(list(value)) & field.is_valid() if value else FALSE
+        ))
+
+    def visit_nin(self, value, field_name, context):
+        return self.pushdown(field_name, {'$nin': value}, value, lambda field: (
+            ~field.isin(list(value)) | field.is_null() if value else TRUE
+        ))
+
+    def visit_exists(self, value, field_name, context):
+        return self.pushdown(
+            field_name, {'$exists': value}, [], lambda field: field.is_valid() if value else field.is_null()
+        )
+
+    def visit_mod(self, value, field_name, context):
+        return self.residual(field_name, {'$mod': value})
+
+    def visit_size(self, value, field_name, context):
+        return self.residual(field_name, {'$size': value})
+
+    def visit_all(self, value, field_name, context):
+        return self.residual(field_name, {'$all': value})
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        regex, flags = value
+        options = ''.join(option for option in 'imsx' if flags & getattr(re, option.upper()))
+        clause = {'$regex': regex, '$options': options} if options else {'$regex': regex}
+        literal = literal_regex(regex, flags)
+        if literal is None or not literal[0]:
+            return self.residual(field_name, clause)
+        literal, anchored, ignorecase = literal
+        function = compute.starts_with if anchored else compute.match_substring
+        return self.pushdown(field_name, clause, [literal], lambda field: function(field, literal, ignore_case=ignorecase))
+    visit_options = visit_regex
+
+    def visit_and(self, parts, field_name, context):
+        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context)
+
+    def visit_or(self, parts, field_name, context):
+        pushdowns = [self.visit_query(part, field_name) for part in parts]
+        expressions = [pushdown.expression for pushdown in pushdowns]
+        if any(expression is TRUE for expression in expressions):
+            expression = TRUE
+        else:
+            expression = reduce(or_, expressions) if expressions else FALSE
+        if not any(pushdown.residual for pushdown in pushdowns):
+            residual = []
+        elif field_name is None:
+            residual = [{'$or': parts}]
+        else:
+            residual = [{field_name: {'$or': parts}}]
+        return Pushdown(expression, residual)
+
+    def render_and(self, parts, field_name, context):
+        expressions = [part.expression for part in parts if part.expression is not TRUE]
+        return Pushdown(
+            reduce(and_, expressions) if expressions else TRUE,
+            sum((part.residual for part in parts), []),
+        )
+
+
+def to_expression(query, schema):
+    """
+    Splits `query` in a :class:`Pushdown` for tables with the given `schema`. The expression can also be used as a
+    ``filter`` for :mod:`pyarrow.dataset`.
+    """
+    return ExpressionVisitor(schema).visit(query)
+
+
+def row_group_stats(row_group):
+    """
+    Gives back the statistics of a row group (from :meth:`pyarrow.parquet.FileMetaData.row_group`) for
+    :func:`mongoql_conv.can_match`, with the null values counted as missing fields.
+    """
+    fields = {}
+    for position in range(row_group.num_columns):
+        column = row_group.column(position)
+        stats = column.statistics
+        fields[column.path_in_schema] = field_stats = {}
+        if stats is None:
+            continue
+        if stats.has_null_count:
+            field_stats['count'] = row_group.num_rows - stats.null_count
+        if stats.has_min_max:
+            field_stats['min'], field_stats['max'] = stats.min, stats.max
+    return {'count': row_group.num_rows, 'fields': fields}
+
+
+def row_groups(metadata, query):
+    """
+    Gives back the indexes of the row groups (of a Parquet file's `metadata`) that might have rows matching `query`.
+    """
+    return [
+        position for position in range(metadata.num_row_groups)
+        if can_match(query, row_group_stats(metadata.row_group(position))) is not False
+    ]
+
+
+def query_columns(query):
+    """
+    Gives back the names of the columns used by `query`.
+    """
+    return set(split_path(field_name)[0] for field_name in field_uses(query, {}))
+
+
+def strip_nulls(value):
+    if isinstance(value, dict):
+        return dict((key, strip_nulls(item)) for key, item in value.items() if item is not None)
+    return value
+
+
+def match_residual(table, residual):
+    """
+    Gives back a boolean mask of the rows of `table` that match all the `residual` queries.
+    """
+    query = residual[0] if len(residual) == 1 else {'$and': residual}
+    columns = [name for name in table.column_names if name in query_columns(query)]
+    func = to_func(query, lax=True)
+    return pyarrow.array([bool(func(strip_nulls(row))) for row in table.select(columns).to_pylist()], pyarrow.bool_())
+
+
+def filter_table(table, query):
+    """
+    Gives back the rows of `table` (a :class:`pyarrow.Table`) that match `query`.
+    """
+    pushdown = to_expression(query, table.schema)
+    if pushdown.expression is not TRUE:
+        table = table.filter(pushdown.expression)
+    if pushdown.residual:
+        table = table.filter(match_residual(table, pushdown.residual))
+    return table
+
+
+def read_table(source, query, columns=None):
+    """
+    Reads the rows of a Parquet file that match `query`. Only the row groups that might match (from the min/max and null
+    count statistics) are read, and in them the columns used by the query first: the other `columns` (all of them if
+    not given) are only read for the row groups with matches.
+    """
+    file = parquet.ParquetFile(source)
+    schema = file.schema_arrow
+    if columns is None:
+        columns = schema.names
+    used = [name for name in schema.names if name in query_columns(query)]
+    rest = [name for name in columns if name not in used]
+    pushdown = to_expression(query, schema)
+    tables = []
+    for position in row_groups(file.metadata, query):
+        table = file.read_row_group(position, columns=used)
+        if rest:
+            table = table.append_column(INDEX, pyarrow.array(range(table.num_rows), pyarrow.int64()))
+        if pushdown.expression is not TRUE:
+            table = table.filter(pushdown.expression)
+        if pushdown.residual:
+            table = table.filter(match_residual(table, pushdown.residual))
+        if not table.num_rows:
+            continue
+        if rest:
+            other = file.read_row_group(position, columns=rest).take(table.column(INDEX))
+            table = pyarrow.Table.from_arrays(
+                [table.column(name) if name in used else other.column(name) for name in columns],
+                schema=pyarrow.schema([schema.field(name) for name in columns]),
+            )
+        else:
+            table = table.select(columns)
+        tables.append(table)
+    if tables:
+        return pyarrow.concat_tables(tables)
+    else:
+        return pyarrow.schema([schema.field(name) for name in columns]).empty_table()
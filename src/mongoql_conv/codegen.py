@@ -0,0 +1,311 @@
+"""
+Builds the query functions straight from :mod:`ast` nodes, so there's no source to format (no ``repr`` of the values)
+and nothing to parse again. The values are held as real objects: literals are constants and everything else (sets,
+compiled regular expressions and so on) is bound to a name. Requires Python 3.
+"""
+from __future__ import absolute_import
+
+import ast
+import linecache
+import re
+import sys
+import weakref
+from itertools import count
+
+from mongoql_conv import FILTERS
+from mongoql_conv import MAPPING
+from mongoql_conv import BaseVisitor
+from mongoql_conv import LaxNone
+from mongoql_conv import Normalizer
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+from mongoql_conv import compile_regex
+from mongoql_conv import literal_regex
+from mongoql_conv import split_path
+from mongoql_conv import subdocument
+
+LITERALS = type(None), bool, int, float, complex, str, bytes
+
+if sys.version_info >= (3, 9):
+    def index(node):
+        return node
+else:
+    index = ast.Index
+
+counter = count()
+
+
+def node(cls, *args):
+    return cls(*args, lineno=1, col_offset=0)
+
+
+def arguments(names, defaults=()):
+    arguments = dict(
+        args=[ast.arg(arg=name, annotation=None, lineno=1, col_offset=0) for name in names],
+        defaults=list(defaults), vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None,
+    )
+    if sys.version_info >= (3, 8):
+        arguments['posonlyargs'] = []
+    return ast.arguments(**arguments)
+
+
+def unparse(tree):
+    return ast.unparse(tree) if hasattr(ast, 'unparse') else ast.dump(tree)
+
+
+def loop(expression):
+    return [ast.comprehension(node(ast.Name, 'item', ast.Store()), node(ast.Name, 'items', ast.Load()), [expression], 0)]
+
+
+#: Builds the body of the :data:`mongoql_conv.FILTERS` from the query expression.
+TEMPLATES = {
+    FILTERS['list']: lambda expression: node(ast.ListComp, node(ast.Name, 'item', ast.Load()), loop(expression)),
+    FILTERS['iter']: lambda expression: node(ast.GeneratorExp, node(ast.Name, 'item', ast.Load()), loop(expression)),
+    FILTERS['count']: lambda expression: node(ast.Call, node(ast.Name, 'sum', ast.Load()), [
+        node(ast.GeneratorExp, node(ast.Constant, 1), loop(expression))
+    ], []),
+    FILTERS['first']: lambda expression: node(ast.Call, node(ast.Name, 'next', ast.Load()), [
+        node(ast.GeneratorExp, node(ast.Name, 'item', ast.Load()), loop(expression)), node(ast.Constant, None)
+    ], []),
+}
+
+
+class AstVisitor(BaseVisitor):
+    """
+    Like :class:`mongoql_conv.ExprVisitor` but gives back :mod:`ast` nodes. The non-literal values are added to
+    `variables`, and to `arguments` if they should be bound as default arguments.
+    """
+    def __init__(self, object_name, use_arguments=True, cost_model=None, schema=None, profile=None, trusted=False):
+        self.object_name = object_name
+        self.use_arguments = use_arguments
+        self.cost_model = cost_model
+        self.schema = None if schema is MAPPING else schema
+        self.profile = profile
+        self.trusted = trusted
+        self.variables = {}
+        self.arguments = []
+
+    def constant(self, value):
+        if type(value) in LITERALS:
+            return node(ast.Constant, value)
+        else:
+            return self.variable(value)
+
+    def variable(self, value):
+        var_name = 'var%s' % len(self.variables)
+        self.variables[var_name] = value
+        if self.use_arguments:
+            self.arguments.append(var_name)
+        return node(ast.Name, var_name, ast.Load())
+
+    def parse(self, source):
+        return ast.parse(source, mode='eval').body
+
+    def container(self, keys, lax=False):
+        container = node(ast.Name, self.object_name, ast.Load())
+        if self.schema is not None and keys:
+            container = self.parse(self.schema.container(self.object_name, keys[0], lax))
+            keys = keys[1:]
+        for key in keys:
+            if lax:
+                get = node(ast.Attribute, container, 'get', ast.Load())
+                container = node(ast.Call, node(ast.Name, 'subdocument', ast.Load()), [
+                    node(ast.Call, get, [self.constant(key)], [])
+                ], [])
+            else:
+                container = node(ast.Subscript, container, index(self.constant(key)), ast.Load())
+        return container
+
+    def field(self, field_name):
+        keys = split_path(field_name)
+        if self.schema is not None and len(keys) == 1:
+            return self.parse(self.schema.field(self.object_name, keys[0]))
+        return node(ast.Subscript, self.container(keys[:-1]), index(self.constant(keys[-1])), ast.Load())
+
+    def exists(self, field_name, negate=False):
+        keys = split_path(field_name)
+        if self.schema is not None and len(keys) == 1:
+            return self.parse(self.schema.exists(self.object_name, keys[0], negate))
+        operator = ast.NotIn() if negate else ast.In()
+        return self.compare(self.constant(keys[-1]), operator, self.container(keys[:-1], True))
+
+    def compare(self, left, operator, right):
+        return node(ast.Compare, left, [operator], [right])
+
+    def visit_gt(self, value, field_name, context):
+        return self.compare(self.field(field_name), ast.Gt(), self.constant(value))
+
+    def visit_gte(self, value, field_name, context):
+        return self.compare(self.field(field_name), ast.GtE(), self.constant(value))
+
+    def visit_lt(self, value, field_name, context):
+        return self.compare(self.field(field_name), ast.Lt(), self.constant(value))
+
+    def visit_lte(self, value, field_name, context):
+        return self.compare(self.field(field_name), ast.LtE(), self.constant(value))
+
+    def visit_ne(self, value, field_name, context):
+        return self.compare(self.field(field_name), ast.NotEq(), self.constant(value))
+
+    def visit_eq(self, value, field_name, context):
+        return self.compare(self.field(field_name), ast.Eq(), self.constant(value))
+
+    def visit_in(self, value, field_name, context, operator=ast.In):
+        return self.compare(self.field(field_name), operator(), self.variable(frozenset(value)))
+
+    def visit_nin(self, value, field_name, context):
+        return self.visit_in(value, field_name, context, ast.NotIn)
+
+    def visit_and(self, parts, field_name, context, operator=ast.And, disjunction=False):
+        return self.render_and([
+            self.visit_query(part, field_name)
+            for part in self.ordered(parts, field_name, disjunction)
+        ], field_name, context, operator)
+
+    def visit_or(self, parts, field_name, context):
+        return self.visit_and(parts, field_name, context, ast.Or, True) if parts else node(ast.Constant, False)
+
+    def render_and(self, parts, field_name, context, operator=ast.And):
+        if not parts:
+            return node(ast.Constant, True)
+        elif len(parts) == 1:
+            return parts[0]
+        else:
+            return node(ast.BoolOp, operator(), parts)
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        return self.search(value, self.field(field_name))
+    visit_options = visit_regex
+
+    def search(self, value, field):
+        literal = literal_regex(*value)
+        if literal is None:
+            search = node(ast.Attribute, self.variable(compile_regex(*value)), 'search', ast.Load())
+            return node(ast.Call, search, [field], [])
+        literal, anchored, ignorecase = literal
+        if ignorecase:
+            field = self.method('lower', field)
+        elif not anchored:
+            field = node(ast.BinOp, node(ast.Constant, ''), ast.Add(), field)
+        if anchored:
+            return self.method('startswith', field, node(ast.Constant, literal))
+        else:
+            return self.compare(node(ast.Constant, literal), ast.In(), field)
+
+    def method(self, name, *args):
+        method = node(ast.Attribute, node(ast.Name, 'str', ast.Load()), name, ast.Load())
+        return node(ast.Call, method, list(args), [])
+
+    def visit_size(self, value, field_name, context):
+        length = node(ast.Call, node(ast.Name, 'len', ast.Load()), [self.field(field_name)], [])
+        return self.compare(length, ast.Eq(), self.constant(value))
+
+    def visit_all(self, value, field_name, context):
+        items = node(ast.Call, node(ast.Name, 'set', ast.Load()), [self.field(field_name)], [])
+        return self.compare(items, ast.GtE(), self.variable(frozenset(value)))
+
+    def visit_mod(self, value, field_name, context):
+        divisor, remainder = value
+        modulo = node(ast.BinOp, self.field(field_name), ast.Mod(), self.constant(divisor))
+        return self.compare(modulo, ast.Eq(), self.constant(remainder))
+
+    def visit_exists(self, value, field_name, context):
+        return self.exists(field_name, not value)
+
+    def render_clause(self, part, field_name, operator):
+        if self.profile is None or part is Skip:
+            return part
+        index = self.profile.add(field_name, operator, unparse(part))
+        return node(ast.Call, node(ast.Name, 'probe', ast.Load()), [
+            node(ast.Constant, index), node(ast.Lambda, arguments([]), part)
+        ], [])
+
+
+class LaxAstVisitor(AstVisitor):
+    """
+    Like :class:`mongoql_conv.LaxExprVisitor` but gives back :mod:`ast` nodes.
+    """
+    def field(self, field_name, default=None):
+        keys = split_path(field_name)
+        if self.schema is not None and len(keys) == 1:
+            return self.parse(self.schema.field(
+                self.object_name, keys[0], True, 'LaxNone' if default is None else repr(default.value)
+            ))
+        get = node(ast.Attribute, self.container(keys[:-1], True), 'get', ast.Load())
+        if default is None:
+            default = node(ast.Name, 'LaxNone', ast.Load())
+        return node(ast.Call, get, [self.constant(keys[-1]), default], [])
+
+    def visit_in(self, value, field_name, context, operator=ast.In, junction=ast.And):
+        return node(ast.BoolOp, junction(), [
+            self.exists(field_name, operator is ast.NotIn),
+            self.compare(self.field(field_name), operator(), self.variable(frozenset(value))),
+        ])
+
+    def visit_nin(self, value, field_name, context):
+        return self.visit_in(value, field_name, context, ast.NotIn, ast.Or)
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        return self.search(value, self.field(field_name, node(ast.Constant, '')))
+    visit_options = visit_regex
+
+
+class Source(object):
+    """
+    The source of a function made by :func:`compile_ast`, rendered only when needed (it's also added to
+    :mod:`linecache` then, for tracebacks).
+    """
+    def __init__(self, tree, namespace, query, filename):
+        self.tree = tree
+        self.namespace = namespace
+        self.query = query
+        self.filename = filename
+        self.rendered = None
+
+    def __str__(self):
+        if self.rendered is None:
+            arguments = self.tree.body.args
+            arguments.defaults = [ast.Constant(self.namespace[default.id]) for default in arguments.defaults]
+            self.rendered = "%s # compiled from %r" % (unparse(self.tree), self.query)
+            linecache.cache[self.filename] = len(self.rendered), None, [self.rendered], self.filename
+        return self.rendered
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __eq__(self, other):
+        return str(self) == other
+
+    def __ne__(self, other):
+        return str(self) != other
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+def compile_ast(query, argument, template, use_arguments=True, lax=False, cost_model=None, normalize=False,
+                schema=None, profile=None, trusted=False):
+    """
+    Like :func:`mongoql_conv.compile_query` but makes the function from :mod:`ast` nodes.
+    """
+    visitor = (LaxAstVisitor if lax else AstVisitor)(
+        'item', use_arguments, cost_model, schema, profile, trusted
+    )
+    expression = visitor.visit(Normalizer().normalize(query) if normalize else query)
+    body = expression if template == '%s' else TEMPLATES[template](expression)
+    tree = ast.Expression(node(ast.Lambda, arguments(
+        [argument] + visitor.arguments, [node(ast.Name, var_name, ast.Load()) for var_name in visitor.arguments]
+    ), body))
+    filename = "<query-function-ast-%s>" % next(counter)
+    namespace = dict(visitor.variables, re=re, LaxNone=LaxNone, subdocument=subdocument)
+    if profile is not None:
+        namespace['probe'] = profile.probe
+    func = eval(compile(tree, filename, 'eval'), namespace)
+    func.query = query
+    func.source = Source(tree, namespace, query, filename)
+    func.cleanup = weakref.ref(func, lambda _, filename=filename: linecache.cache.pop(filename, None))
+    return func
@@ -0,0 +1,305 @@
+from __future__ import absolute_import
+
+import re
+from bisect import bisect_left
+from bisect import bisect_right
+from bisect import insort
+from collections import namedtuple
+from functools import reduce
+from operator import itemgetter
+
+from mongoql_conv import BaseVisitor
+from mongoql_conv import Missing
+from mongoql_conv import Normalizer
+from mongoql_conv import QueryCache
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+from mongoql_conv import lookup
+from mongoql_conv import normalize
+from mongoql_conv import to_filter
+
+
+class Plan(namedtuple('Plan', ['ids', 'residual', 'indexes'])):
+    """
+    A query plan: `ids` are the candidate rows (``None`` means all the rows), `residual` is a list of queries that the
+    candidates must still match and `indexes` are the names of the fields looked up in an index.
+    """
+    __slots__ = ()
+
+
+#: Decides which values can be compared (and indexed), the same way the normalizer does (booleans have no kind).
+NORMALIZER = Normalizer()
+
+
+class HashIndex(object):
+    """
+    Maps values to sets of row ids. Rows with unhashable values aren't indexed.
+    """
+    kind = 'hash'
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, value, row_id):
+        try:
+            self.buckets.setdefault(value, set()).add(row_id)
+        except TypeError:
+            pass
+
+    def update(self, pairs):
+        for value, row_id in pairs:
+            self.add(value, row_id)
+
+    def eq(self, value):
+        try:
+            return set(self.buckets.get(value, ()))
+        except TypeError:
+            return
+
+    def in_(self, values):
+        try:
+            return set().union(*[self.buckets.get(value, ()) for value in values])
+        except TypeError:
+            return
+
+    def searchable(self, lower, upper):
+        return False
+
+    def range(self, lower, upper):
+        return
+
+
+class SortedIndex(object):
+    """
+    Sorted lists of values and row ids (one list for numbers and one for strings), searched with :mod:`bisect`. Rows
+    with other types of values aren't indexed. Booleans aren't either but they compare with numbers, so once a boolean
+    is added the ranges of numbers aren't looked up in the index anymore.
+    """
+    kind = 'sorted'
+
+    def __init__(self):
+        self.keys = {'number': [], 'string': []}
+        self.booleans = False
+
+    def add(self, value, row_id):
+        kind = NORMALIZER.kind(value)
+        if kind is not None:
+            insort(self.keys[kind], (value, row_id))
+        elif isinstance(value, bool):
+            self.booleans = True
+
+    def update(self, pairs):
+        for value, row_id in pairs:
+            kind = NORMALIZER.kind(value)
+            if kind is not None:
+                self.keys[kind].append((value, row_id))
+            elif isinstance(value, bool):
+                self.booleans = True
+        for keys in self.keys.values():
+            keys.sort()
+
+    def eq(self, value):
+        return self.range((value, True), (value, True))
+
+    def in_(self, values):
+        ids = set()
+        for value in values:
+            found = self.eq(value)
+            if found is None:
+                return
+            ids |= found
+        return ids
+
+    def searchable(self, lower, upper):
+        kinds = set(NORMALIZER.kind(bound[0]) for bound in (lower, upper) if bound is not None)
+        if len(kinds) == 1 and not (self.booleans and 'number' in kinds):
+            return kinds.pop()
+
+    def range(self, lower, upper):
+        """
+        Gives back the ids of the rows with values between `lower` and `upper` (``(value, inclusive)`` pairs or
+        ``None``).
+        """
+        kind = self.searchable(lower, upper)
+        if not kind:
+            return
+        keys = self.keys[kind]
+        start, end = 0, len(keys)
+        if lower is not None:
+            value, inclusive = lower
+            start = bisect_left(keys, (value,) if inclusive else (value, float('inf')))
+        if upper is not None:
+            value, inclusive = upper
+            end = bisect_right(keys, (value, float('inf')) if inclusive else (value,))
+        return set(map(itemgetter(1), keys[start:end]))
+
+
+class PlanVisitor(BaseVisitor):
+    """
+    Makes a :class:`Plan` for a query: the clauses that can be answered from the indexes of the `collection` give the
+    candidate rows, and the rest of the clauses become the residual query.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def residual(self, operator, value, field_name):
+        return Plan(None, [{field_name: {operator: value}}], [])
+
+    def lookup(self, operator, value, field_name, *args):
+        index = self.collection.indexes.get(field_name)
+        ids = None if index is None else getattr(index, operator)(*args)
+        if ids is None:
+            return self.residual('$' + operator.rstrip('_'), value, field_name)
+        else:
+            return Plan(ids, [], [field_name])
+
+    def visit_eq(self, value, field_name, context):
+        return self.lookup('eq', value, field_name, value)
+
+    def visit_in(self, value, field_name, context):
+        return self.lookup('in_', value, field_name, value)
+
+    def visit_gt(self, value, field_name, context):
+        return self.lookup_range('$gt', value, field_name, context)
+
+    def visit_gte(self, value, field_name, context):
+        return self.lookup_range('$gte', value, field_name, context)
+
+    def visit_lt(self, value, field_name, context):
+        return self.lookup_range('$lt', value, field_name, context)
+
+    def visit_lte(self, value, field_name, context):
+        return self.lookup_range('$lte', value, field_name, context)
+
+    def bound(self, context, operators):
+        for operator in operators:
+            if operator in context:
+                return operator, (context[operator], operator in ('$gte', '$lte'))
+        return None, None
+
+    def lookup_range(self, operator, value, field_name, context):
+        index = self.collection.indexes.get(field_name)
+        if index is None:
+            return self.residual(operator, value, field_name)
+        lower_operator, lower = self.bound(context, ('$gt', '$gte'))
+        upper_operator, upper = self.bound(context, ('$lt', '$lte'))
+        if operator not in (lower_operator, upper_operator) or not index.searchable(lower, upper):
+            bound = value, operator in ('$gte', '$lte')
+            lower, upper = (bound, None) if operator in ('$gt', '$gte') else (None, bound)
+        elif operator == upper_operator and lower is not None:
+            return Skip  # both bounds are looked up when the lower bound is visited
+        ids = index.range(lower, upper)
+        if ids is None:
+            return self.residual(operator, value, field_name)
+        else:
+            return Plan(ids, [], [field_name])
+
+    def visit_ne(self, value, field_name, context):
+        return self.residual('$ne', value, field_name)
+
+    def visit_nin(self, value, field_name, context):
+        return self.residual('$nin', value, field_name)
+
+    def visit_mod(self, value, field_name, context):
+        return self.residual('$mod', value, field_name)
+
+    def visit_size(self, value, field_name, context):
+        return self.residual('$size', value, field_name)
+
+    def visit_all(self, value, field_name, context):
+        return self.residual('$all', value, field_name)
+
+    def visit_exists(self, value, field_name, context):
+        return self.residual('$exists', value, field_name)
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        regex, flags = value
+        options = ''.join(option for option in 'imsx' if flags & getattr(re, option.upper()))
+        return Plan(None, [{field_name: {'$regex': regex, '$options': options}}], [])
+    visit_options = visit_regex
+
+    def visit_and(self, parts, field_name, context):
+        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context)
+
+    def visit_or(self, parts, field_name, context):
+        plans = [self.visit_query(part, field_name) for part in parts]
+        if any(plan.ids is None for plan in plans):
+            ids = None
+        else:
+            ids = set().union(*[plan.ids for plan in plans])
+        if ids is not None and not any(plan.residual for plan in plans):
+            residual = []
+        elif field_name is None:
+            residual = [{'$or': parts}]
+        else:
+            residual = [{field_name: {'$or': parts}}]
+        return Plan(ids, residual, sum((plan.indexes for plan in plans), []) if ids is not None else [])
+
+    def render_and(self, parts, field_name, context):
+        candidates = sorted((plan.ids for plan in parts if plan.ids is not None), key=len)
+        return Plan(
+            reduce(set.intersection, candidates) if candidates else None,
+            sum((plan.residual for plan in parts), []),
+            sum((plan.indexes for plan in parts), []),
+        )
+
+
+class Collection(object):
+    """
+    An in-memory list of documents with indexes. Use :meth:`create_index` to index a field with a hash index (for
+    ``$eq``/``$in``) or a sorted index (for ranges too). Documents without the indexed field are left out of the
+    index, as if `lax` was used.
+    """
+    def __init__(self, documents=(), lax=False, cache_size=256):
+        self.documents = []
+        self.indexes = {}
+        self.lax = lax
+        self.cache = QueryCache(cache_size)
+        self.extend(documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def insert(self, document):
+        row_id = len(self.documents)
+        self.documents.append(document)
+        for field_name, index in self.indexes.items():
+            value = lookup(document, field_name)
+            if value is not Missing:
+                index.add(value, row_id)
+
+    def extend(self, documents):
+        for document in documents:
+            self.insert(document)
+
+    def create_index(self, field_name, kind='hash'):
+        if kind == 'hash':
+            index = HashIndex()
+        elif kind == 'sorted':
+            index = SortedIndex()
+        else:
+            raise ValueError("Invalid index kind %r. Must be 'hash' or 'sorted'." % kind)
+        values = ((lookup(document, field_name), row_id) for row_id, document in enumerate(self.documents))
+        index.update((value, row_id) for value, row_id in values if value is not Missing)
+        self.indexes[field_name] = index
+
+    def plan(self, query):
+        return PlanVisitor(self).visit(normalize(query))
+
+    def find(self, query):
+        plan = self.plan(query)
+        if plan.ids is None:
+            return to_filter(self.make_query(plan.residual), lax=self.lax, cache=self.cache)(self.documents)
+        candidates = [self.documents[row_id] for row_id in sorted(plan.ids)]
+        if plan.residual:
+            return to_filter(self.make_query(plan.residual), lax=self.lax, cache=self.cache)(candidates)
+        else:
+            return candidates
+
+    def make_query(self, residual):
+        return residual[0] if len(residual) == 1 else {'$and': residual}
@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+
+import heapq
+import zlib
+from itertools import islice
+
+from six import exec_
+from six import string_types
+
+from mongoql_conv import InvalidQuery
+from mongoql_conv import Missing
+from mongoql_conv import register
+from mongoql_conv import split_path
+from mongoql_conv import to_filter
+from mongoql_conv.live import sort_key
+
+
+class Descending(object):
+    """
+    Reverses the order of a sort key (for the descending fields of a sort on several fields).
+    """
+    __slots__ = 'key',
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def parse_sort(sort):
+    """
+    Gives back a list of ``(keys, direction)`` pairs for `sort`: a field name, a list of ``(field name, 1 or -1)``
+    pairs or an (ordered) dict.
+    """
+    if isinstance(sort, string_types):
+        sort = [(sort, 1)]
+    elif isinstance(sort, dict):
+        sort = sort.items()
+    fields = []
+    for item in sort:
+        if isinstance(item, string_types):
+            item = item, 1
+        field_name, direction = item
+        if direction not in (1, -1) or isinstance(direction, bool):
+            raise InvalidQuery("Invalid sort direction %r for %r. Must be 1 or -1." % (direction, field_name))
+        fields.append((split_path(field_name), direction))
+    if not fields:
+        raise InvalidQuery("Invalid sort %r. Must have at least one field." % (sort,))
+    return fields
+
+
+def get_path(document, keys):
+    for key in keys:
+        get = getattr(document, 'get', None)
+        if get is None:
+            return Missing
+        document = get(key, Missing)
+        if document is Missing:
+            return Missing
+    return document
+
+
+def to_sort_key(sort):
+    """
+    Compiles `sort` (see :func:`parse_sort`) to a ``(key, reverse)`` pair to sort the documents with, ordering the
+    values like :class:`mongoql_conv.LiveQuery` does.
+    """
+    fields = parse_sort(sort)
+    reverse = all(direction == -1 for _, direction in fields)
+    mixed = not reverse and any(direction == -1 for _, direction in fields)
+    parts = []
+    for keys, direction in fields:
+        value = 'item.get(%r, Missing)' % keys if len(keys) == 1 else 'get_path(item, %r)' % (keys,)
+        parts.append(('Descending(sort_key(%s))' if mixed and direction == -1 else 'sort_key(%s)') % value)
+    source = "lambda item: %s # compiled from %r" % (parts[0] if len(parts) == 1 else '(%s)' % ', '.join(parts), sort)
+    filename = "<sort-function-%x>" % zlib.adler32(source.encode('utf8'))
+    namespace = {'Missing': Missing, 'get_path': get_path, 'sort_key': sort_key, 'Descending': Descending}
+    return register(eval(compile(source, filename, 'eval'), namespace), sort, source), reverse
+
+
+def to_projection(projection):
+    """
+    Compiles `projection` (a dict like ``{"a": 1, "b.c": 1}`` or ``{"a": 0}``, or a list of the included fields) to a
+    function that gives back the projected copy of a document. The ``_id`` field is included unless it's excluded
+    explicitly. Gives back ``None`` for an empty projection.
+    """
+    if isinstance(projection, dict):
+        items = list(projection.items())
+    else:
+        items = [(field_name, 1) for field_name in projection]
+    for field_name, value in items:
+        if not isinstance(field_name, string_types) or not field_name:
+            raise InvalidQuery("Invalid projection field %r. Must be a non-empty string." % (field_name,))
+        if not isinstance(value, (bool, int, float)):
+            raise InvalidQuery("Invalid projection %r for %r. Must be 1 or 0." % (value, field_name))
+    included = [field_name for field_name, value in items if value and field_name != '_id']
+    excluded = [field_name for field_name, value in items if not value and field_name != '_id']
+    if included and excluded:
+        raise InvalidQuery("Invalid projection %r. Can't mix included and excluded fields (other than _id)." % (
+            projection,
+        ))
+    with_id = projection.get('_id', 1) if isinstance(projection, dict) else True
+    if included or with_id and not excluded and '_id' in [field_name for field_name, _ in items]:
+        lines = ['result = {}']
+        paths = [split_path(field_name) for field_name in (['_id'] if with_id else []) + included]
+        for position, keys in enumerate(paths):
+            for other in paths[:position]:
+                length = min(len(keys), len(other))
+                if keys[:length] == other[:length]:
+                    raise InvalidQuery("Invalid projection %r. The %r and %r fields collide." % (
+                        projection, '.'.join(other), '.'.join(keys)
+                    ))
+            if len(keys) == 1:
+                lines.append('value = item.get(%r, Missing)' % keys)
+            else:
+                lines.append('value = get_path(item, %r)' % (keys,))
+            lines.append('if value is not Missing:')
+            lines.append('    result%s[%r] = value' % (''.join('.setdefault(%r, {})' % key for key in keys[:-1]), keys[-1]))
+    elif excluded or not with_id:
+        lines = ['result = dict(item)']
+        for keys in [split_path(field_name) for field_name in excluded] + ([] if with_id else [('_id',)]):
+            if len(keys) == 1:
+                lines.append('result.pop(%r, None)' % keys)
+            else:
+                lines.append('drop(result, %r)' % (keys,))
+    else:
+        return None
+    source = "# compiled from %r\ndef project(item):\n%s\n" % (projection, '\n'.join(
+        '    ' + line for line in lines + ['return result']
+    ))
+    filename = "<projection-function-%x>" % zlib.adler32(source.encode('utf8'))
+    scope = {}
+    exec_(compile(source, filename, 'exec'), {'Missing': Missing, 'get_path': get_path, 'drop': drop}, scope)
+    return register(scope['project'], projection, source)
+
+
+def drop(document, keys):
+    """
+    Removes a nested field from `document` (a copy), copying the nested dicts on the way.
+    """
+    for key in keys[:-1]:
+        nested = document.get(key)
+        if not isinstance(nested, dict):
+            return
+        nested = document[key] = dict(nested)
+        document = nested
+    document.pop(keys[-1], None)
+
+
+def find(query, documents, projection=None, sort=None, skip=0, limit=0, use_arguments=True, lax=False, cache=None):
+    """
+    Gives back an iterator over the documents that match `query` (see :func:`mongoql_conv.to_filter`), like MongoDB's
+    ``find``: sorted by `sort` (see :func:`parse_sort`), without the first `skip` matches, at most `limit` of them (``0``
+    means no limit) and projected with `projection` (see :func:`to_projection`).
+
+    Without `sort` the documents are streamed (stopping after the last one that's needed). With `sort` and `limit` only
+    the top ``skip + limit`` matches are kept (in a heap), instead of sorting all of them.
+    """
+    if skip < 0 or limit < 0:
+        raise ValueError("Invalid skip %r or limit %r. Must be positive." % (skip, limit))
+    func = to_filter({} if query is None else query, 'iter', use_arguments, lax, cache)
+    project = None if projection is None else to_projection(projection)
+    matches = func(documents)
+    if sort is None:
+        results = islice(matches, skip, skip + limit if limit else None)
+    else:
+        key, reverse = to_sort_key(sort)
+        if limit:
+            results = (heapq.nlargest if reverse else heapq.nsmallest)(skip + limit, matches, key)[skip:]
+        else:
+            results = sorted(matches, key=key, reverse=reverse)[skip:]
+        results = iter(results)
+    if project is None:
+        return results
+    return (project(document) for document in results)
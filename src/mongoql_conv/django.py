@@ -1,17 +1,42 @@
 from __future__ import absolute_import
 
-from functools import partial
-from operator import iand
-from operator import ior
-from functools import reduce
 from re import IGNORECASE
 
 from django.db.models import Q
 
-from mongoql_conv import BaseVisitor, Stripped, Skip
+from mongoql_conv import BaseVisitor
+from mongoql_conv import Normalizer
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+
+
+def combine(children, connector):
+    """
+    Builds one flat ``Q`` for the `children` (instead of combining them two at a time, with a copy of the tree each
+    time). The children that are ``Q`` objects with the same connector are merged in.
+    """
+    if len(children) == 1:
+        return children[0]
+    node = Q()
+    node.connector = connector
+    for child in children:
+        if isinstance(child, Q) and not child.negated and (child.connector == connector or len(child.children) == 1):
+            node.children.extend(child.children)
+        else:
+            node.children.append(child)
+    return node
 
 
 class DjangoVisitor(BaseVisitor):
+    """
+    Builds a ``Q`` tree. The ``$in``/``$nin`` lists with more than `in_threshold` values are split in `in_threshold`
+    sized chunks, or, if `in_subquery` is given, replaced with ``in_subquery(field_name, values)`` (a queryset or
+    anything else that works with ``__in``, like a subquery over a temporary table).
+    """
+    def __init__(self, in_threshold=None, in_subquery=None):
+        self.in_threshold = in_threshold
+        self.in_subquery = in_subquery
+
     def visit_gt(self, value, field_name, context):
         return Q(("%s__gt" % field_name, value))
 
@@ -30,20 +55,30 @@ class DjangoVisitor(BaseVisitor):
     def visit_eq(self, value, field_name, context):
         return Q((field_name, value))
 
-    def visit_in(self, value, field_name, context, operator='in'):
-        return Q(("%s__in" % field_name, value))
+    def visit_in(self, value, field_name, context):
+        lookup = "%s__in" % field_name
+        if self.in_threshold is None or len(value) <= self.in_threshold:
+            return Q((lookup, value))
+        elif self.in_subquery is not None:
+            return Q((lookup, self.in_subquery(field_name, value)))
+        else:
+            values = list(value)
+            return combine([
+                Q((lookup, values[start:start + self.in_threshold]))
+                for start in range(0, len(values), self.in_threshold)
+            ], Q.OR)
 
     def visit_nin(self, value, field_name, context):
         return ~self.visit_in(value, field_name, context)
 
-    def visit_and(self, parts, field_name, context, reducer=iand):
-        return reduce(reducer, [self.visit_query(part, field_name) for part in parts]) if parts else Q()
+    def visit_and(self, parts, field_name, context, connector=Q.AND):
+        return combine([self.visit_query(part, field_name) for part in parts], connector) if parts else Q()
 
     def visit_or(self, parts, field_name, context):
-        return self.visit_and(parts, field_name, context, partial(ior))
+        return self.visit_and(parts, field_name, context, Q.OR) if parts else Q(pk__in=[])
 
     def render_and(self, parts, field_name, context):
-        return reduce(iand, parts) if parts else Q()
+        return combine(parts, Q.AND) if parts else Q()
 
     def validate_regex(self, value, field_name, context, acceptable_options=('i',)):
         return super(DjangoVisitor, self).validate_regex(value, field_name, context, acceptable_options)
@@ -61,4 +96,10 @@ class DjangoVisitor(BaseVisitor):
     visit_options = visit_regex
 
 
-to_Q = to_django = DjangoVisitor().visit
+def to_Q(query, normalize=False, in_threshold=None, in_subquery=None):
+    if normalize:
+        query = Normalizer().normalize(query)
+    return DjangoVisitor(in_threshold, in_subquery).visit(query)
+
+
+to_django = to_Q
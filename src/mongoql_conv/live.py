@@ -0,0 +1,213 @@
+from __future__ import absolute_import
+
+from bisect import bisect_left
+from bisect import insort
+from collections import OrderedDict
+from datetime import datetime
+
+from six import binary_type
+
+from mongoql_conv import Mapping
+from mongoql_conv import Missing
+from mongoql_conv import field_uses
+from mongoql_conv import lookup
+from mongoql_conv import split_path
+from mongoql_conv import to_func
+from mongoql_conv.collection import NORMALIZER
+
+#: How the values of each kind are ordered by ``sort`` (like MongoDB orders the BSON types): missing fields and
+#: ``None`` first, then NaN, numbers, strings, subdocuments, lists, binary data, booleans, dates and the rest.
+KIND_RANKS = {'number': 2, 'string': 3}
+
+
+def sort_key(value):
+    """
+    Gives back a key that orders `value` among values of any kind, without comparing values of different kinds.
+    """
+    if value is Missing or value is None:
+        return 0, None
+    elif isinstance(value, bool):
+        return 7, value
+    rank = KIND_RANKS.get(NORMALIZER.kind(value))
+    if rank is not None:
+        return rank, value
+    elif isinstance(value, float):
+        return 1, None
+    elif isinstance(value, Mapping):
+        return 4, tuple((sort_key(key), sort_key(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return 5, tuple(sort_key(item) for item in value)
+    elif isinstance(value, binary_type):
+        return 6, value
+    elif isinstance(value, datetime):
+        return 8, value
+    return 9, type(value).__name__, value
+
+
+class SortedBlocks(object):
+    """
+    A sorted list of unique items kept in blocks of up to ``2 * load`` items, so adding or removing an item moves
+    ``O(load)`` items instead of ``O(n)`` (the block is found with :mod:`bisect` over the last item of each block).
+    """
+    def __init__(self, load=256):
+        self.load = load
+        self.blocks = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (item for block in self.blocks for item in block)
+
+    def __reversed__(self):
+        return (item for block in reversed(self.blocks) for item in reversed(block))
+
+    def add(self, item):
+        position = bisect_left(self.maxes, item)
+        if position == len(self.maxes):
+            if not self.blocks:
+                self.blocks.append([])
+                self.maxes.append(item)
+            position -= 1
+            self.blocks[position].append(item)
+            self.maxes[position] = item
+        else:
+            insort(self.blocks[position], item)
+        block = self.blocks[position]
+        if len(block) > 2 * self.load:
+            self.blocks[position:position + 1] = block[:self.load], block[self.load:]
+            self.maxes[position:position + 1] = block[self.load - 1], block[-1]
+        self.size += 1
+
+    def remove(self, item):
+        position = bisect_left(self.maxes, item)
+        block = self.blocks[position]
+        del block[bisect_left(block, item)]
+        if block:
+            self.maxes[position] = block[-1]
+        else:
+            del self.blocks[position]
+            del self.maxes[position]
+        self.size -= 1
+
+
+class LiveQuery(object):
+    """
+    Keeps the documents that match `query` up to date: feed it the changes with :meth:`insert`, :meth:`update` and
+    :meth:`delete` (each one costs a call of the compiled query at most). The documents are identified by their `key`
+    field and, if `sort` (a field name) is given, iterated by that field (in `reverse` order if asked). The order is
+    kept in a :class:`SortedBlocks`, so keeping it up to date doesn't cost ``O(n)`` for each change.
+
+    Callbacks added with :meth:`subscribe` are called with ``("added", document)``, ``("removed", document)`` or
+    ``("changed", document)`` (a match that still matches after an update).
+    """
+    def __init__(self, query, documents=(), key='_id', sort=None, reverse=False, lax=False):
+        self.query = query
+        self.func = to_func(query, lax=lax)
+        self.key = key
+        self.sort = sort
+        self.reverse = reverse
+        self.watched = set(split_path(name) for name in field_uses(query, {}))
+        if sort is not None:
+            self.watched.add(split_path(sort))
+        self.prefixes = set(keys[:position] for keys in self.watched for position in range(1, len(keys) + 1))
+        self.affected = {}
+        self.matches = OrderedDict()
+        self.sort_keys = {}
+        self.order = SortedBlocks()
+        self.callbacks = []
+        for document in documents:
+            self.insert(document)
+
+    def __len__(self):
+        return len(self.matches)
+
+    @property
+    def count(self):
+        return len(self.matches)
+
+    def __contains__(self, key):
+        return key in self.matches
+
+    def __iter__(self):
+        if self.sort is None:
+            return iter(list(self.matches.values()))
+        order = reversed(self.order) if self.reverse else self.order
+        return iter([self.matches[key] for _, key in order])
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.callbacks.remove(callback)
+
+    def notify(self, event, document):
+        for callback in self.callbacks:
+            callback(event, document)
+
+    def affects(self, changed):
+        """
+        Checks if changing the fields in `changed` can change the result of the query (or the order) for a document.
+        """
+        for field_name in changed:
+            affected = self.affected.get(field_name)
+            if affected is None:
+                keys = split_path(field_name)
+                affected = self.affected[field_name] = keys in self.prefixes or any(
+                    keys[:position] in self.watched for position in range(1, len(keys))
+                )
+            if affected:
+                return True
+        return False
+
+    def insert(self, document):
+        if self.func(document):
+            self.add(lookup(document, self.key), document, 'added')
+
+    def update(self, document, changed=None):
+        """
+        Applies an update (`document` is the new version). If `changed` (the names of the changed fields) is given and
+        none of them are used by the query, the query isn't run again.
+        """
+        key = lookup(document, self.key)
+        if changed is not None and not self.affects(changed):
+            if key in self.matches:
+                self.matches[key] = document
+                self.notify('changed', document)
+            return
+        if self.func(document):
+            self.add(key, document, 'changed' if key in self.matches else 'added')
+        elif key in self.matches:
+            self.remove(key)
+
+    def delete(self, document):
+        """
+        Applies a deletion (`document` only needs the `key` field).
+        """
+        key = lookup(document, self.key)
+        if key in self.matches:
+            self.remove(key)
+
+    def add(self, key, document, event):
+        self.matches[key] = document
+        if self.sort is not None:
+            item = sort_key(lookup(document, self.sort)), key
+            if self.sort_keys.get(key) != item:
+                if key in self.sort_keys:
+                    self.unsort(key)
+                self.order.add(item)
+                self.sort_keys[key] = item
+        self.notify(event, document)
+
+    def remove(self, key):
+        document = self.matches.pop(key)
+        if self.sort is not None:
+            self.unsort(key)
+        self.notify('removed', document)
+
+    def unsort(self, key):
+        item = self.sort_keys.pop(key)
+        self.order.remove(item)
@@ -0,0 +1,328 @@
+from __future__ import absolute_import
+
+from bisect import bisect_left
+from bisect import bisect_right
+from bisect import insort
+from collections import defaultdict
+
+from mongoql_conv import BaseVisitor
+from mongoql_conv import Missing
+from mongoql_conv import QueryCache
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+from mongoql_conv import compile_regex
+from mongoql_conv import fingerprint
+from mongoql_conv import lookup
+from mongoql_conv import normalize
+from mongoql_conv import to_func
+from mongoql_conv.collection import NORMALIZER
+
+#: Gives the slice of a sorted list of bounds (``(value, predicate id, predicate)`` tuples) that a value satisfies.
+RANGE_SLICES = {
+    '$gt': lambda keys, value: keys[:bisect_left(keys, (value,))],
+    '$gte': lambda keys, value: keys[:bisect_right(keys, (value, float('inf')))],
+    '$lt': lambda keys, value: keys[bisect_right(keys, (value, float('inf'))):],
+    '$lte': lambda keys, value: keys[bisect_left(keys, (value,)):],
+}
+
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    else:
+        return value == value
+
+
+class ClauseVisitor(BaseVisitor):
+    """
+    Splits a query in clauses: ``(field_name, operator, value)`` tuples for the clauses that can be shared between
+    queries (``$eq``, ``$in``, ranges and ``$regex``) and queries for everything else.
+    """
+    def residual(self, operator, value, field_name):
+        return [{field_name: {operator: value}}]
+
+    def visit_eq(self, value, field_name, context):
+        if is_hashable(value):
+            return [(field_name, '$eq', value)]
+        else:
+            return self.residual('$eq', value, field_name)
+
+    def visit_in(self, value, field_name, context):
+        if all(is_hashable(item) for item in value):
+            return [(field_name, '$in', frozenset(value))]
+        else:
+            return self.residual('$in', value, field_name)
+
+    def visit_gt(self, value, field_name, context, operator='$gt'):
+        if NORMALIZER.kind(value) is None:
+            return self.residual(operator, value, field_name)
+        else:
+            return [(field_name, operator, value)]
+
+    def visit_gte(self, value, field_name, context):
+        return self.visit_gt(value, field_name, context, '$gte')
+
+    def visit_lt(self, value, field_name, context):
+        return self.visit_gt(value, field_name, context, '$lt')
+
+    def visit_lte(self, value, field_name, context):
+        return self.visit_gt(value, field_name, context, '$lte')
+
+    def visit_ne(self, value, field_name, context):
+        return self.residual('$ne', value, field_name)
+
+    def visit_nin(self, value, field_name, context):
+        return self.residual('$nin', value, field_name)
+
+    def visit_mod(self, value, field_name, context):
+        return self.residual('$mod', value, field_name)
+
+    def visit_size(self, value, field_name, context):
+        return self.residual('$size', value, field_name)
+
+    def visit_all(self, value, field_name, context):
+        return self.residual('$all', value, field_name)
+
+    def visit_exists(self, value, field_name, context):
+        return self.residual('$exists', value, field_name)
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        return [(field_name, '$regex', value)]
+    visit_options = visit_regex
+
+    def visit_and(self, parts, field_name, context):
+        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context)
+
+    def visit_or(self, parts, field_name, context):
+        if field_name is None:
+            return [{'$or': parts}]
+        else:
+            return [{field_name: {'$or': parts}}]
+
+    def render_and(self, parts, field_name, context):
+        return sum(parts, [])
+
+
+class Predicate(object):
+    """
+    A clause shared by the queries in `query_ids`. The queries in `anchored` are looked up through this clause.
+    """
+    __slots__ = 'id', 'field_name', 'operator', 'value', 'regex', 'query_ids', 'anchored'
+
+    def __init__(self, id, field_name, operator, value):
+        self.id = id
+        self.field_name = field_name
+        self.operator = operator
+        self.value = value
+        self.regex = compile_regex(*value) if operator == '$regex' else None
+        self.query_ids = set()
+        self.anchored = set()
+
+    def test(self, document):
+        if self.regex is not None:
+            value = lookup(document, self.field_name, '')
+            return isinstance(value, (str, type(u''))) and bool(self.regex.search(value))
+        value = lookup(document, self.field_name)
+        if value is Missing:
+            return False
+        elif self.operator == '$eq':
+            return value == self.value
+        elif self.operator == '$in':
+            try:
+                return value in self.value
+            except TypeError:
+                return False
+        elif NORMALIZER.kind(value) != NORMALIZER.kind(self.value):
+            return False
+        elif self.operator == '$gt':
+            return value > self.value
+        elif self.operator == '$gte':
+            return value >= self.value
+        elif self.operator == '$lt':
+            return value < self.value
+        else:
+            return value <= self.value
+
+
+class QueryMatcher(object):
+    """
+    Matches documents against many queries at once. The clauses of all the queries are shared and each query is looked
+    up through one of its clauses (its anchor):
+
+    * ``$eq`` and ``$in`` anchors go in a hash table for each field,
+    * range anchors go in sorted lists of bounds for each field and operator,
+    * regular expression anchors are grouped by field.
+
+    The other clauses of the candidate queries are checked after, but each distinct clause is evaluated at most once
+    for a document. The rest of the query (``$ne``, ``$or`` and so on) is compiled with ``to_func``, once for all the
+    queries that have the same rest. The queries are matched just like ``to_func(query, lax=True)`` does, except that
+    values that can't be compared (including booleans with numbers, as in :meth:`mongoql_conv.Normalizer.kind`) don't
+    raise ``TypeError``, they just don't match (and neither does the rest of a query if it raises, eg: ``$mod`` on a
+    string).
+    """
+    #: The preferred anchors come first.
+    anchor_order = '$eq', '$in', '$gt', '$gte', '$lt', '$lte', '$regex'
+
+    def __init__(self, queries=(), cache_size=1024):
+        self.queries = {}
+        self.predicates = {}
+        self.hashes = defaultdict(lambda: defaultdict(set))
+        self.ranges = defaultdict(lambda: defaultdict(lambda: {'number': [], 'string': []}))
+        self.regexes = defaultdict(set)
+        self.residuals = {}
+        self.unconstrained = set()
+        self.cache = QueryCache(cache_size)
+        self.next_id = 0
+        for query_id, query in dict(queries).items():
+            self.add(query_id, query)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __contains__(self, query_id):
+        return query_id in self.queries
+
+    def add(self, query_id, query):
+        """
+        Adds (or replaces) the query with the given id.
+        """
+        clauses = ClauseVisitor().visit(normalize(query))
+        residual = [clause for clause in clauses if isinstance(clause, dict)]
+        if residual:
+            residual = residual[0] if len(residual) == 1 else {'$and': residual}
+            residual_key = fingerprint(residual)
+            func = to_func(residual, lax=True, cache=self.cache)
+        else:
+            residual_key = func = None
+        if query_id in self.queries:
+            self.remove(query_id)
+        predicates = []
+        for clause in clauses:
+            if isinstance(clause, tuple):
+                predicate = self.predicates.get(clause)
+                if predicate is None:
+                    predicate = self.predicates[clause] = Predicate(self.next_id, *clause)
+                    self.next_id += 1
+                if predicate not in predicates:
+                    predicates.append(predicate)
+                    predicate.query_ids.add(query_id)
+        if predicates:
+            anchor = min(predicates, key=lambda predicate: self.anchor_order.index(predicate.operator))
+            predicates.remove(anchor)
+            if not anchor.anchored:
+                self.index(anchor)
+            anchor.anchored.add(query_id)
+        else:
+            anchor = None
+            self.unconstrained.add(query_id)
+        if residual_key is not None:
+            self.residuals.setdefault(residual_key, [func, 0])[1] += 1
+        self.queries[query_id] = anchor, predicates, residual_key
+
+    def remove(self, query_id):
+        """
+        Removes the query with the given id. Raises `KeyError` if there's no such query.
+        """
+        anchor, predicates, residual_key = self.queries.pop(query_id)
+        self.unconstrained.discard(query_id)
+        if residual_key is not None:
+            entry = self.residuals[residual_key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.residuals[residual_key]
+        if anchor is not None:
+            anchor.anchored.discard(query_id)
+            if not anchor.anchored:
+                self.unindex(anchor)
+            predicates = predicates + [anchor]
+        for predicate in predicates:
+            predicate.query_ids.discard(query_id)
+            if not predicate.query_ids:
+                del self.predicates[predicate.field_name, predicate.operator, predicate.value]
+
+    def index(self, predicate):
+        field_name, operator, value = predicate.field_name, predicate.operator, predicate.value
+        if operator in ('$eq', '$in'):
+            for item in [value] if operator == '$eq' else value:
+                self.hashes[field_name][item].add(predicate)
+        elif operator == '$regex':
+            self.regexes[field_name].add(predicate)
+        else:
+            insort(self.ranges[field_name][operator][NORMALIZER.kind(value)], (value, predicate.id, predicate))
+
+    def unindex(self, predicate):
+        field_name, operator, value = predicate.field_name, predicate.operator, predicate.value
+        if operator in ('$eq', '$in'):
+            buckets = self.hashes[field_name]
+            for item in [value] if operator == '$eq' else value:
+                buckets[item].discard(predicate)
+                if not buckets[item]:
+                    del buckets[item]
+        elif operator == '$regex':
+            self.regexes[field_name].discard(predicate)
+        else:
+            keys = self.ranges[field_name][operator][NORMALIZER.kind(value)]
+            del keys[bisect_left(keys, (value, predicate.id))]
+
+    def matching_anchors(self, document):
+        """
+        Gives back the anchors that match the document.
+        """
+        for field_name, buckets in self.hashes.items():
+            value = lookup(document, field_name)
+            if value is not Missing:
+                try:
+                    for predicate in buckets.get(value, ()):
+                        yield predicate
+                except TypeError:
+                    pass
+        for field_name, operators in self.ranges.items():
+            value = lookup(document, field_name)
+            if value is not Missing:
+                kind = NORMALIZER.kind(value)
+                if kind is not None:
+                    for operator, kinds in operators.items():
+                        for _, _, predicate in RANGE_SLICES[operator](kinds[kind], value):
+                            yield predicate
+        for predicates in self.regexes.values():
+            for predicate in predicates:
+                if predicate.test(document):
+                    yield predicate
+
+    def match(self, document):
+        """
+        Gives back the set of ids of the queries that match the document.
+        """
+        results = {}
+        candidates = list(self.unconstrained)
+        for predicate in self.matching_anchors(document):
+            results[predicate.id] = True
+            candidates.extend(predicate.anchored)
+        matched = set()
+        for query_id in candidates:
+            _, predicates, residual_key = self.queries[query_id]
+            for predicate in predicates:
+                result = results.get(predicate.id)
+                if result is None:
+                    result = results[predicate.id] = predicate.test(document)
+                if not result:
+                    break
+            else:
+                if residual_key is not None:
+                    result = results.get(residual_key)
+                    if result is None:
+                        result = results[residual_key] = self.test_residual(residual_key, document)
+                    if not result:
+                        continue
+                matched.add(query_id)
+        return matched
+
+    def test_residual(self, residual_key, document):
+        try:
+            return bool(self.residuals[residual_key][0](document))
+        except Exception:
+            return False
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+from functools import reduce
+from operator import and_
+from operator import eq
+from operator import ge
+from operator import gt
+from operator import le
+from operator import lt
+from operator import ne
+from operator import or_
+
+import numpy
+
+from mongoql_conv import BaseVisitor
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+from mongoql_conv import compile_regex
+
+
+def in_values(value):
+    """
+    Gives back the values of ``$in``/``$nin`` for :func:`numpy.isin`. Values of mixed types are kept in an object array
+    (a plain list would be converted to a single dtype, usually strings, and ``1`` wouldn't match ``1`` anymore).
+    """
+    values = list(value)
+    if len(set(type(item) for item in values)) > 1:
+        return numpy.array(values, dtype=object)
+    return values
+
+
+class MaskVisitor(BaseVisitor):
+    """
+    Evaluates the query over a mapping of columns (numpy arrays, all with the same length) and gives back a boolean
+    mask. Masked values (from ``numpy.ma`` arrays) are treated as missing fields. Missing columns raise `KeyError`, just
+    like the functions made by ``to_func``, unless `lax` is used.
+    """
+    def __init__(self, columns, lax=False, size=None):
+        self.columns = columns
+        self.lax = lax
+        if size is None:
+            size = len(next(iter(columns.values()))) if columns else 0
+        self.size = size
+
+    def constant(self, value):
+        return numpy.full(self.size, value, dtype=bool)
+
+    def column(self, field_name):
+        if field_name in self.columns:
+            column = self.columns[field_name]
+            mask = numpy.ma.getmask(column)
+            return numpy.ma.getdata(column), None if mask is numpy.ma.nomask else ~mask
+        elif self.lax:
+            return None, None
+        else:
+            raise KeyError(field_name)
+
+    def compare(self, operator, value, field_name):
+        data, present = self.column(field_name)
+        if data is None:
+            return self.constant(False)
+        result = numpy.asarray(operator(data, value), dtype=bool)
+        if present is not None:
+            result &= present
+        return result
+
+    def visit_gt(self, value, field_name, context):
+        return self.compare(gt, value, field_name)
+
+    def visit_gte(self, value, field_name, context):
+        return self.compare(ge, value, field_name)
+
+    def visit_lt(self, value, field_name, context):
+        return self.compare(lt, value, field_name)
+
+    def visit_lte(self, value, field_name, context):
+        return self.compare(le, value, field_name)
+
+    def visit_ne(self, value, field_name, context):
+        return self.compare(ne, value, field_name)
+
+    def visit_eq(self, value, field_name, context):
+        return self.compare(eq, value, field_name)
+
+    def visit_in(self, value, field_name, context):
+        return self.compare(numpy.isin, in_values(value), field_name)
+
+    def visit_nin(self, value, field_name, context):
+        data, present = self.column(field_name)
+        if data is None:
+            return self.constant(True)
+        result = ~numpy.isin(data, in_values(value))
+        if present is not None:
+            result |= ~present
+        return result
+
+    def visit_mod(self, value, field_name, context):
+        divisor, remainder = value
+        return self.compare(lambda data, _: data % divisor == remainder, None, field_name)
+
+    def visit_exists(self, value, field_name, context):
+        data, present = self.column(field_name)
+        if data is None:
+            return self.constant(not value)
+        elif present is None:
+            return self.constant(bool(value))
+        else:
+            return present.copy() if value else ~present
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        regex = compile_regex(*value)
+        data, present = self.column(field_name)
+        if data is None:
+            return self.constant(bool(regex.search('')))
+        if present is None:
+            present = self.constant(True)
+        return numpy.fromiter(
+            (bool(regex.search(item if ok else '')) for item, ok in zip(data, present)),
+            dtype=bool, count=len(data)
+        )
+    visit_options = visit_regex
+
+    def visit_and(self, parts, field_name, context, operator=and_):
+        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context, operator)
+
+    def visit_or(self, parts, field_name, context):
+        return self.visit_and(parts, field_name, context, or_) if parts else self.constant(False)
+
+    def render_and(self, parts, field_name, context, operator=and_):
+        return reduce(operator, parts) if parts else self.constant(True)
+
+
+def to_mask(query, columns, lax=False, size=None):
+    return MaskVisitor(columns, lax, size).visit(query)
@@ -0,0 +1,243 @@
+from __future__ import absolute_import
+
+import re
+
+from mongoql_conv import BaseVisitor
+from mongoql_conv import Missing
+from mongoql_conv import QueryCache
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+from mongoql_conv import split_path
+from mongoql_conv import to_func
+from mongoql_conv.collection import NORMALIZER
+
+#: The functions that check the values of a field (the same clauses come up for every chunk).
+CACHE = QueryCache(1024)
+
+
+def matcher(field_name, clause):
+    return to_func({field_name: clause}, lax=True, cache=CACHE)
+
+
+def evaluate(func, keys, value):
+    """
+    Matches a document that has `value` at `keys` (no field if `value` is ``Missing``). Gives back ``None`` if the
+    function fails.
+    """
+    document = {}
+    if value is not Missing:
+        for key in reversed(keys):
+            value = {key: value}
+        document = value
+    try:
+        return bool(func(document))
+    except Exception:
+        return
+
+
+def all_of(results):
+    results = list(results)
+    if False in results:
+        return False
+    return None if None in results else True
+
+
+def any_of(results):
+    results = list(results)
+    if True in results:
+        return True
+    return None if None in results else False
+
+
+def agree(results):
+    results = set(results)
+    return results.pop() if len(results) == 1 else None
+
+
+def negate(result):
+    return None if result is None else not result
+
+
+class StatsVisitor(BaseVisitor):
+    """
+    Checks a query against the statistics of a chunk of documents (see :func:`can_match`). Gives back ``False`` if no
+    document can match, ``True`` if all of them match and ``None`` if it can't tell.
+    """
+    def __init__(self, stats):
+        self.count = stats.get('count')
+        self.fields = stats.get('fields', {})
+        self.roots = set(split_path(field_name)[0] for field_name in self.fields)
+
+    def check(self, field_name, clause, test=None, negated=False, present=None):
+        """
+        Combines the results for the documents without the field (matched against an empty document) and the ones with
+        it: from the distinct values if they're known, else from ``test(min, max)`` (negated if `negated`) if there's
+        a range, else `present`.
+        """
+        keys = split_path(field_name)
+        if keys[0] not in self.roots:
+            return evaluate(matcher(field_name, clause), keys, Missing)
+        stats = self.fields.get(field_name)
+        if stats is None:
+            return
+        count = stats.get('count')
+        if count == 0:
+            return evaluate(matcher(field_name, clause), keys, Missing)
+        values = stats.get('values')
+        if values is not None:
+            func = matcher(field_name, clause)
+            present = agree(evaluate(func, keys, value) for value in values)
+        elif test is not None and stats.get('min', Missing) is not Missing and stats.get('max', Missing) is not Missing:
+            present = self.range(test, stats['min'], stats['max'])
+            if negated:
+                present = negate(present)
+        if count is not None and self.count is not None and count >= self.count:
+            return present
+        elif present is not None and present is evaluate(matcher(field_name, clause), keys, Missing):
+            return present
+
+    def range(self, test, lower, upper):
+        try:
+            result = test(lower, upper)
+        except TypeError:
+            return
+        if result and (isinstance(lower, float) or isinstance(upper, float)):
+            return  # NaN values can be left out of the range
+        return result
+
+    def visit_gt(self, value, field_name, context):
+        return self.check(field_name, {'$gt': value}, lambda lower, upper: (
+            True if lower > value else False if upper <= value else None
+        ))
+
+    def visit_gte(self, value, field_name, context):
+        return self.check(field_name, {'$gte': value}, lambda lower, upper: (
+            True if lower >= value else False if upper < value else None
+        ))
+
+    def visit_lt(self, value, field_name, context):
+        return self.check(field_name, {'$lt': value}, lambda lower, upper: (
+            True if upper < value else False if lower >= value else None
+        ))
+
+    def visit_lte(self, value, field_name, context):
+        return self.check(field_name, {'$lte': value}, lambda lower, upper: (
+            True if upper <= value else False if lower > value else None
+        ))
+
+    def visit_eq(self, value, field_name, context):
+        return self.check(field_name, {'$eq': value}, lambda lower, upper: self.contains(lower, upper, [value]))
+
+    def visit_ne(self, value, field_name, context):
+        return self.check(field_name, {'$ne': value}, lambda lower, upper: self.contains(lower, upper, [value]), True)
+
+    def visit_in(self, value, field_name, context):
+        return self.check(field_name, {'$in': value}, lambda lower, upper: self.contains(lower, upper, value))
+
+    def visit_nin(self, value, field_name, context):
+        return self.check(field_name, {'$nin': value}, lambda lower, upper: self.contains(lower, upper, value), True)
+
+    def contains(self, lower, upper, values):
+        """
+        Checks if the values between `lower` and `upper` are all in `values` (``True``), not in them (``False``) or
+        can't tell (``None``).
+        """
+        if lower == upper and lower in values:
+            return True
+        return None if any(lower <= value <= upper for value in values) else False
+
+    def visit_exists(self, value, field_name, context):
+        return self.check(field_name, {'$exists': value}, present=bool(value))
+
+    def visit_mod(self, value, field_name, context):
+        return self.check(field_name, {'$mod': value})
+
+    def visit_size(self, value, field_name, context):
+        return self.check(field_name, {'$size': value})
+
+    def visit_all(self, value, field_name, context):
+        return self.check(field_name, {'$all': value})
+
+    def visit_regex(self, value, field_name, context):
+        if value is Stripped:
+            return Skip
+        regex, flags = value
+        options = ''.join(option for option in 'imsx' if flags & getattr(re, option.upper()))
+        return self.check(field_name, {'$regex': regex, '$options': options} if options else {'$regex': regex})
+    visit_options = visit_regex
+
+    def visit_and(self, parts, field_name, context):
+        return all_of(self.visit_query(part, field_name) for part in parts)
+
+    def visit_or(self, parts, field_name, context):
+        return any_of(self.visit_query(part, field_name) for part in parts)
+
+    def render_and(self, parts, field_name, context):
+        return all_of(parts)
+
+
+def can_match(query, stats):
+    """
+    Checks if the documents of a chunk can match `query` (like ``to_func(query, lax=True)`` matches them), from the
+    `stats` of the chunk (see :func:`collect_stats`). Gives back ``False`` if none of them match, ``True`` if all of
+    them match and ``None`` if some might match.
+    """
+    return StatsVisitor(stats).visit(query)
+
+
+def flatten(document, prefix=''):
+    for key, value in document.items():
+        field_name = prefix + key
+        yield field_name, value
+        if isinstance(value, dict):
+            for item in flatten(value, field_name + '.'):
+                yield item
+
+
+def collect_stats(documents, max_values=100):
+    """
+    Makes the statistics of a chunk of documents: the number of documents (``count``) and for each field (the ones in
+    subdocuments too) the number of documents that have it (``count``), the smallest and the largest values (``min`` and
+    ``max``, if all the values are numbers or all of them are strings) and the distinct values (``values``, if there
+    are at most `max_values` of them, all hashable).
+
+    The fields that aren't in the statistics are missing in all the documents. Any of the statistics can be left out
+    (eg: when they're kept by other tools), they're only used when they're there.
+    """
+    fields = {}
+    kinds = {}
+    count = 0
+    for document in documents:
+        count += 1
+        for field_name, value in flatten(document):
+            stats = fields.get(field_name)
+            if stats is None:
+                stats = fields[field_name] = {'count': 0, 'values': set()}
+                kinds[field_name] = NORMALIZER.kind(value)
+            stats['count'] += 1
+            if kinds[field_name] is not None:
+                if NORMALIZER.kind(value) != kinds[field_name]:
+                    kinds[field_name] = None
+                    stats.pop('min', None)
+                    stats.pop('max', None)
+                elif 'min' in stats:
+                    stats['min'] = min(stats['min'], value)
+                    stats['max'] = max(stats['max'], value)
+                else:
+                    stats['min'] = stats['max'] = value
+            values = stats.get('values')
+            if values is not None:
+                try:
+                    values.add(value)
+                except TypeError:
+                    del stats['values']
+                else:
+                    if len(values) > max_values:
+                        del stats['values']
+    for stats in fields.values():
+        if 'values' in stats:
+            try:
+                stats['values'] = sorted(stats['values'])
+            except TypeError:
+                stats['values'] = list(stats['values'])
+    return {'count': count, 'fields': fields}
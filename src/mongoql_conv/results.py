@@ -0,0 +1,226 @@
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from collections import namedtuple
+from threading import RLock
+
+from mongoql_conv import Normalizer
+from mongoql_conv import QueryCache
+from mongoql_conv import fingerprint
+from mongoql_conv import split_path
+from mongoql_conv import to_filter
+from mongoql_conv import to_func
+from mongoql_conv.pruning import evaluate
+from mongoql_conv.pruning import matcher
+
+NORMALIZER = Normalizer()
+
+
+def simplify(query):
+    return NORMALIZER.simplify(NORMALIZER.parse(query))
+
+
+def is_junction(node, operator):
+    return isinstance(node, tuple) and len(node) == 2 and node[0] == operator
+
+
+def implies(query, other):
+    """
+    Checks if all the documents that match `query` also match `other` (like ``to_func(query, lax=True)`` matches
+    them). Gives back ``False`` if it can't tell.
+    """
+    return node_implies(simplify(query), simplify(other))
+
+
+def node_implies(node, other):
+    """
+    Like :func:`implies` but for nodes of the normalized query tree (see :class:`mongoql_conv.Normalizer`).
+    """
+    if node is False or other is True:
+        return True
+    elif node is True or other is False:
+        return False
+    elif is_junction(other, '$and'):
+        return all(node_implies(node, child) for child in other[1])
+    elif is_junction(node, '$or'):
+        return all(node_implies(child, other) for child in node[1])
+    elif is_junction(other, '$or') and any(node_implies(node, child) for child in other[1]):
+        return True
+    leaves = node[1] if is_junction(node, '$and') else [node]
+    if any(len(child) == 2 and node_implies(child, other) for child in leaves):
+        return True
+    elif len(other) == 2 or other[0] is None:
+        return other in leaves
+    return leaf_implied([leaf for leaf in leaves if len(leaf) == 3 and leaf[0] == other[0]], other)
+
+
+def kind(value):
+    return NORMALIZER.kind(value)
+
+
+def comparable(value, other):
+    return kind(value) is not None and kind(value) == kind(other)
+
+
+def excludes(bound, value, lower):
+    """
+    Checks if the `bound` (an ``(operator, value)`` pair, the lower bound if `lower`) leaves out `value`.
+    """
+    operator, limit = bound
+    if not comparable(limit, value):
+        return False
+    elif lower:
+        return value < limit or value == limit and operator == '$gt'
+    else:
+        return value > limit or value == limit and operator == '$lt'
+
+
+def leaf_implied(leaves, leaf):
+    """
+    Checks if the field of a document that matches all the `leaves` (``(field, operator, value)`` nodes, all on the
+    same field) matches `leaf` too.
+    """
+    if leaf in leaves:
+        return True
+    field_name, operator, value = leaf
+    allowed = None
+    lowers, uppers, unequal, excluded = [], [], [], []
+    exists = None
+    for _, leaf_operator, leaf_value in leaves:
+        if leaf_operator in ('$eq', None):
+            allowed = [leaf_value]
+        elif leaf_operator == '$in' and allowed is None:
+            allowed = list(leaf_value)
+        elif leaf_operator in ('$gt', '$gte'):
+            lowers.append((leaf_operator, leaf_value))
+        elif leaf_operator in ('$lt', '$lte'):
+            uppers.append((leaf_operator, leaf_value))
+        elif leaf_operator == '$ne':
+            unequal.append(leaf_value)
+        elif leaf_operator == '$nin':
+            excluded.extend(leaf_value)
+        elif leaf_operator == '$exists':
+            exists = bool(leaf_value)
+    # in lax mode only missing fields match $exists: false, $nin and (for some values) $regex, $size and $all
+    present = exists or allowed is not None or bool(lowers or uppers or unequal)
+
+    if allowed is not None:
+        func = matcher(field_name, value if operator == '$regex' else {operator or '$eq': value})
+        keys = split_path(field_name)
+        return all(evaluate(func, keys, item) is True for item in allowed)
+
+    def left_out(item):
+        return (
+            item in unequal or item in excluded or
+            any(excludes(bound, item, True) for bound in lowers) or any(excludes(bound, item, False) for bound in uppers)
+        )
+
+    if operator in ('$gt', '$gte'):
+        return any(comparable(limit, value) and (
+            limit > value or limit == value and (operator == '$gte' or bound == '$gt')
+        ) for bound, limit in lowers)
+    elif operator in ('$lt', '$lte'):
+        return any(comparable(limit, value) and (
+            limit < value or limit == value and (operator == '$lte' or bound == '$lt')
+        ) for bound, limit in uppers)
+    elif operator == '$ne':
+        return present and left_out(value)
+    elif operator == '$nin':
+        return all(left_out(item) for item in value)
+    elif operator == '$exists':
+        return present if value else exists is False
+    return False
+
+
+ResultCacheInfo = namedtuple('ResultCacheInfo', ['hits', 'reuses', 'misses', 'evictions', 'size', 'maxsize'])
+
+
+class ResultCache(object):
+    """
+    Caches the results of queries over `documents`. A query that isn't cached is answered from the smallest cached
+    result of a query that :func:`implies` it (filtering that result, not all the `documents`). The least recently
+    used results are evicted when there are more than `maxsize` of them, or more than `max_items` documents in all the
+    results.
+
+    The queries are matched like ``to_func(query, lax=True)`` does, just like :func:`implies` assumes. With
+    ``lax=False`` (strict functions, that raise for missing fields) the cached results are only used for the same
+    query, because a strict query could raise for documents that a broader cached query left out.
+
+    When `documents` change call :meth:`invalidate` with the changed documents (the old and the new versions, the
+    inserted and the deleted documents) or :meth:`clear`.
+    """
+    def __init__(self, documents, maxsize=128, max_items=None, lax=True, cache_size=256):
+        self.documents = documents
+        self.maxsize = maxsize
+        self.max_items = max_items
+        self.lax = lax
+        self.cache = QueryCache(cache_size)
+        self.entries = OrderedDict()
+        self.items = 0
+        self.hits = self.reuses = self.misses = self.evictions = 0
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def info(self):
+        return ResultCacheInfo(self.hits, self.reuses, self.misses, self.evictions, len(self.entries), self.maxsize)
+
+    def find(self, query):
+        """
+        Gives back a list of the documents that match `query` (in the order of `documents`).
+        """
+        func = to_filter(query, lax=self.lax, cache=self.cache)
+        key = fingerprint(query)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                self.hits += 1
+                return list(entry[1])
+            node = simplify(query)
+            source = self.documents
+            for other, results, _ in self.entries.values() if self.lax else ():
+                if (source is self.documents or len(results) < len(source)) and node_implies(node, other):
+                    source = results
+            if source is self.documents:
+                self.misses += 1
+            else:
+                self.reuses += 1
+        results = func(source)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = node, results, to_func(query, lax=self.lax, cache=self.cache)
+                self.items += len(results)
+                self.shrink()
+        return list(results)
+
+    def shrink(self):
+        while self.entries and (
+            len(self.entries) > self.maxsize or self.max_items is not None and self.items > self.max_items
+        ):
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def drop(self, key):
+        self.items -= len(self.entries.pop(key)[1])
+
+    def invalidate(self, *documents):
+        """
+        Drops the cached results of the queries that match any of `documents`.
+        """
+        with self.lock:
+            for key, (_, _, func) in list(self.entries.items()):
+                if any(self.matches(func, document) for document in documents):
+                    self.drop(key)
+
+    def matches(self, func, document):
+        try:
+            return func(document)
+        except Exception:
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.items = 0
@@ -0,0 +1,342 @@
+"""
+Renders queries as SQL ``WHERE`` clauses with bound parameters. ``NULL`` works like ``None`` (``$ne`` and ``$nin`` match
+it) except for ``$exists``, that takes it as a missing field. Values are compared the way the database compares them.
+"""
+from __future__ import absolute_import
+
+import re
+from collections import namedtuple
+
+from six import string_types
+
+from mongoql_conv import BaseVisitor
+from mongoql_conv import InvalidQuery
+from mongoql_conv import QueryCache
+from mongoql_conv import Skip
+from mongoql_conv import Stripped
+
+
+class Statement(namedtuple('Statement', ['where', 'params', 'tables'])):
+    """
+    A ``WHERE`` clause, its parameters and the temporary tables (``(name, values)`` pairs) that must be loaded before
+    running it.
+    """
+    __slots__ = ()
+
+
+CONTAINERS = list, tuple, set, frozenset
+
+
+class Dialect(object):
+    """
+    Generic SQL with ``?`` placeholders and no ``$regex``.
+    """
+    name = 'generic'
+    placeholder = '?'
+    modulo = '%'
+    regex_options = ()
+    temp_table = 'CREATE TEMPORARY TABLE IF NOT EXISTS %s (value)'
+
+    def quote(self, name):
+        return '"%s"' % name.replace('"', '""')
+
+    def regex(self, column, placeholder, flags):
+        raise InvalidQuery("%s doesn't support operator '$regex'" % type(self).__name__)
+
+    def regex_param(self, regex, flags):
+        return regex
+
+    def prepare(self, connection):
+        pass
+
+    def load_table(self, cursor, name, values):
+        cursor.execute(self.temp_table % name)
+        cursor.execute('DELETE FROM %s' % name)
+        cursor.executemany('INSERT INTO %s VALUES (%s)' % (name, self.placeholder), [(value,) for value in values])
+
+
+def regexp(regex, value):
+    if value is None:
+        value = ''
+    return isinstance(value, string_types) and re.search(regex, value) is not None
+
+
+class SQLiteDialect(Dialect):
+    """
+    SQLite, with a ``REGEXP`` function made from :func:`re.search` (the options are inlined in the regular expression).
+    """
+    name = 'sqlite'
+    regex_options = 's', 'x', 'm', 'i'
+
+    def regex(self, column, placeholder, flags):
+        return '%s REGEXP %s' % (column, placeholder)
+
+    def regex_param(self, regex, flags):
+        options = ''.join(option for option in 'imsx' if flags & getattr(re, option.upper()))
+        return '(?%s)%s' % (options, regex) if options else regex
+
+    def prepare(self, connection):
+        connection.create_function('REGEXP', 2, regexp)
+
+
+class PostgreSQLDialect(Dialect):
+    """
+    PostgreSQL (for drivers with the ``format`` paramstyle, like psycopg2), with the ``~`` and ``~*`` operators.
+    """
+    name = 'postgresql'
+    placeholder = '%s'
+    modulo = '%%'
+    regex_options = 'i',
+
+    def regex(self, column, placeholder, flags):
+        return '%s %s %s' % (column, '~*' if flags & re.IGNORECASE else '~', placeholder)
+
+
+SQLITE = SQLiteDialect()
+
+
+def padded(size):
+    """
+    Rounds `size` up to a power of two, so that ``IN`` lists of similar sizes give the same statement.
+    """
+    return 1 << (size - 1).bit_length() if size else 0
+
+
+def count_values(value):
+    return sum(1 for item in value if item is not None)
+
+
+def single(value):
+    return [value]
+
+
+def in_values(value):
+    values = [item for item in value if item is not None]
+    return values + values[-1:] * (padded(len(values)) - len(values))
+
+
+class SQLVisitor(BaseVisitor):
+    """
+    Renders the query as a ``WHERE`` clause, collecting the parameters in `params`. The field names are looked up in
+    `columns` (the SQL expressions there are used as they are), the other fields are quoted column names. ``$in`` and
+    ``$nin`` with more than `in_threshold` values look into a temporary table (collected in `tables`).
+    """
+    def __init__(self, columns=None, dialect=None, in_threshold=100):
+        self.columns = columns or {}
+        self.dialect = dialect or SQLITE
+        self.in_threshold = in_threshold
+        self.params = []
+        self.tables = []
+        self.bindings = []
+        self.table_bindings = []
+        self.leaves = 0
+
+    def column(self, field_name):
+        if field_name in self.columns:
+            return self.columns[field_name]
+        else:
+            return self.dialect.quote(field_name)
+
+    def leaf(self):
+        """
+        Counts the values in the query (in the same order as :func:`shape` does).
+        """
+        self.leaves += 1
+        return self.leaves - 1
+
+    def bind(self, leaf, convert, value):
+        params = convert(value)
+        self.params.extend(params)
+        self.bindings.append((leaf, convert))
+        return [self.dialect.placeholder] * len(params)
+
+    def compare(self, operator, value, field_name):
+        leaf = self.leaf()
+        return '%s %s %s' % (self.column(field_name), operator, self.bind(leaf, single, value)[0])
+
+    def visit_gt(self, value, field_name, context):
+        return self.compare('>', value, field_name)
+
+    def visit_gte(self, value, field_name, context):
+        return self.compare('>=', value, field_name)
+
+    def visit_lt(self, value, field_name, context):
+        return self.compare('<', value, field_name)
+
+    def visit_lte(self, value, field_name, context):
+        return self.compare('<=', value, field_name)
+
+    def visit_ne(self, value, field_name, context):
+        if value is None:
+            self.leaf()
+            return '%s IS NOT NULL' % self.column(field_name)
+        return '%s IS NULL OR %s' % (self.column(field_name), self.compare('!=', value, field_name))
+
+    def visit_eq(self, value, field_name, context):
+        if value is None:
+            self.leaf()
+            return '%s IS NULL' % self.column(field_name)
+        return self.compare('=', value, field_name)
+
+    def visit_in(self, value, field_name, context, negate=False):
+        leaf = self.leaf()
+        column = self.column(field_name)
+        operator = 'NOT IN' if negate else 'IN'
+        has_none = None in value
+        size = count_values(value)
+        if size > self.in_threshold:
+            name = 'mongoql_in_%s' % len(self.tables)
+            self.tables.append((name, [item for item in value if item is not None]))
+            self.table_bindings.append((name, leaf))
+            member = '%s %s (SELECT value FROM %s)' % (column, operator, name)
+        elif size:
+            member = '%s %s (%s)' % (column, operator, ', '.join(self.bind(leaf, in_values, value)))
+        else:
+            member = None
+        if not negate:
+            parts = [member] if member else []
+            if has_none:
+                parts.append('%s IS NULL' % column)
+            return ' OR '.join(parts) or '0 = 1'
+        elif has_none:
+            return ' AND '.join(['%s IS NOT NULL' % column] + ([member] if member else []))
+        elif member:
+            return '%s IS NULL OR %s' % (column, member)
+        else:
+            return '1 = 1'
+
+    def visit_nin(self, value, field_name, context):
+        return self.visit_in(value, field_name, context, True)
+
+    def visit_mod(self, value, field_name, context):
+        leaf = self.leaf()
+        divisor, remainder = self.bind(leaf, list, value)
+        return '%s %s %s = %s' % (self.column(field_name), self.dialect.modulo, divisor, remainder)
+
+    def visit_exists(self, value, field_name, context):
+        self.leaf()
+        return '%s IS %sNULL' % (self.column(field_name), 'NOT ' if value else '')
+
+    def validate_regex(self, value, field_name, context, acceptable_options=None):
+        return super(SQLVisitor, self).validate_regex(value, field_name, context, self.dialect.regex_options)
+    validate_options = validate_regex
+
+    def visit_regex(self, value, field_name, context):
+        leaf = self.leaf()
+        if value is Stripped:
+            return Skip
+        regex, flags = value
+        param = self.dialect.regex_param(regex, flags)
+        placeholder = self.bind(leaf, lambda _, param=param: [param], None)[0]
+        return self.dialect.regex(self.column(field_name), placeholder, flags)
+    visit_options = visit_regex
+
+    def visit_and(self, parts, field_name, context, operator=' AND '):
+        return self.render_and([self.visit_query(part, field_name) for part in parts], field_name, context, operator)
+
+    def visit_or(self, parts, field_name, context):
+        return self.visit_and(parts, field_name, context, ' OR ') if parts else '0 = 1'
+
+    def render_and(self, parts, field_name, context, operator=' AND '):
+        multiple = len(parts) > 1
+        return operator.join("(%s)" % part if multiple else part for part in parts) or '1 = 1'
+
+
+def shape(query, leaves, in_threshold=100):
+    """
+    Gives back a key that's the same for all the queries that render to the same ``WHERE`` clause (the values are
+    replaced by their types). The values are added to `leaves`, in the order the visitor sees them.
+    """
+    items = []
+    for name, value in query.items():
+        if name in ('$and', '$or') and isinstance(value, CONTAINERS):
+            items.append((name, tuple(
+                shape(part, leaves, in_threshold) if isinstance(part, dict) else type(part).__name__
+                for part in value
+            )))
+        elif isinstance(value, dict) and not name.startswith('$'):
+            items.append((name, shape(value, leaves, in_threshold)))
+        else:
+            leaves.append(value)
+            if value is None:
+                items.append((name, None))
+            elif name == '$exists':
+                items.append((name, bool(value)))
+            elif name in ('$regex', '$options') and isinstance(value, string_types):
+                items.append((name, value))
+            elif isinstance(value, CONTAINERS):
+                has_none = None in value
+                size = count_values(value)
+                items.append((name, (
+                    type(value).__name__, 'table' if size > in_threshold else padded(size), has_none
+                )))
+            else:
+                items.append((name, type(value).__name__))
+    return tuple(items)
+
+
+class Template(object):
+    """
+    A rendered ``WHERE`` clause that makes the :class:`Statement` for any query with the same shape.
+    """
+    def __init__(self, where, bindings, table_bindings):
+        self.where = where
+        self.bindings = bindings
+        self.table_bindings = table_bindings
+
+    def render(self, leaves):
+        params = []
+        for leaf, convert in self.bindings:
+            params.extend(convert(leaves[leaf]))
+        tables = [
+            (name, [item for item in leaves[leaf] if item is not None])
+            for name, leaf in self.table_bindings
+        ]
+        return Statement(self.where, params, tables)
+
+
+class StatementCache(QueryCache):
+    """
+    A :class:`mongoql_conv.QueryCache` for the statements made by :func:`to_sql`.
+    """
+    def evict(self, template):
+        self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def to_sql(query, columns=None, dialect=None, in_threshold=100, cache=None):
+    """
+    Gives back a :class:`Statement` for `query`. With a `cache` (a :class:`StatementCache`) queries that differ only in
+    their values aren't visited again: the ``WHERE`` clause is the same, only the parameters are collected.
+    """
+    dialect = dialect or SQLITE
+    leaves = []
+    if cache is not None:
+        key = (shape(query, leaves, in_threshold), tuple(sorted((columns or {}).items())), dialect.name, in_threshold)
+        template = cache.get(key)
+        if template is not None:
+            return template.render(leaves)
+    visitor = SQLVisitor(columns, dialect, in_threshold)
+    where = visitor.visit(query)
+    if cache is not None and visitor.leaves == len(leaves):
+        cache.set(key, Template(where, visitor.bindings, visitor.table_bindings))
+    return Statement(where, visitor.params, visitor.tables)
+
+
+def select(connection, table, query, fields='*', columns=None, dialect=None, in_threshold=100, cache=None):
+    """
+    Runs ``SELECT fields FROM table WHERE ...`` on a DB-API `connection` and gives back the cursor. The `table` and the
+    `fields` are used as they are. The temporary tables are loaded again for each statement, so don't run another
+    statement before you're done with the cursor.
+    """
+    dialect = dialect or SQLITE
+    statement = to_sql(query, columns, dialect, in_threshold, cache)
+    dialect.prepare(connection)
+    cursor = connection.cursor()
+    for name, values in statement.tables:
+        dialect.load_table(cursor, name, values)
+    cursor.execute('SELECT %s FROM %s WHERE %s' % (fields, table, statement.where), statement.params)
+    return cursor